@@ -0,0 +1,334 @@
+import array
+import math
+import os
+import struct
+import wave
+
+try:
+    # audioop computes the RMS in C but is not available on every Python version
+    import audioop
+except ImportError:
+    audioop = None
+
+"""
+Contains helper functions only, not a lambda function file
+Splits long PCM wav recordings at silence boundaries into overlapping segments so that each
+segment can be transcribed by its own Transcribe job. Only the stretches of the recording around
+each planned cut are read to find the silences, and they are read as streams, so the whole
+recording never has to be read, held in memory or stored on disk.
+Also reads the channel count from the header of wav, mp3 and flac recordings
+"""
+
+# Recordings shorter than this are transcribed as a single job
+SPLIT_THRESHOLD_SECONDS = float(os.getenv('SPLIT_THRESHOLD_SECONDS', default='1800'))
+# Target length of a single segment before the overlap is added
+TARGET_SEGMENT_SECONDS = float(os.getenv('TARGET_SEGMENT_SECONDS', default='900'))
+# Audio shared by two neighbouring segments, used by the stitcher to reconcile speaker labels
+OVERLAP_SECONDS = float(os.getenv('SEGMENT_OVERLAP_SECONDS', default='20'))
+# How far away from the target cut the splitter may look for silence
+SILENCE_SEARCH_SECONDS = 30.0
+# Length of the window whose RMS energy is used for silence detection
+WINDOW_SECONDS = 0.1
+
+# Only 8-bit unsigned and 16-bit signed PCM can be read without extra dependencies
+SAMPLE_WIDTH_TO_TYPECODE = {1: 'B', 2: 'h'}
+# fmt chunk format tags, WAVE_FORMAT_EXTENSIBLE keeps the actual tag in the first bytes of its sub format
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+# Channel mode of an mp3 frame header that has a single channel, the other modes are stereo, joint stereo and
+# dual channel
+MP3_CHANNEL_MODE_MONO = 3
+
+
+def read_wav_format(header):
+    """
+    Parses the RIFF chunks of a wav header directly, so every format tag is understood, including the
+    u-law, A-law and WAVE_FORMAT_EXTENSIBLE recordings that the wave module rejects
+
+    :param header: The first bytes of the wav file, up to and including the header of the data chunk
+    :return: Dict with the 'format_tag', 'channels', 'sample_rate', 'byte_rate', 'block_align' and
+             'bits_per_sample' of the fmt chunk, and the 'data_offset' and 'data_size' of the data chunk
+             if it was found, None if the header is not a wav header
+    """
+    if len(header) < 12 or header[0:4] != b'RIFF' or header[8:12] != b'WAVE':
+        return None
+    wav_format = None
+    position = 12
+    while position + 8 <= len(header):
+        chunk_id = header[position:position + 4]
+        chunk_size = struct.unpack_from('<I', header, position + 4)[0]
+        body = position + 8
+        if chunk_id == b'fmt ' and body + 16 <= len(header):
+            format_tag, channels, sample_rate, byte_rate, block_align, bits_per_sample = \
+                struct.unpack_from('<HHIIHH', header, body)
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and chunk_size >= 40 and body + 26 <= len(header):
+                format_tag = struct.unpack_from('<H', header, body + 24)[0]
+            wav_format = {'format_tag': format_tag, 'channels': channels, 'sample_rate': sample_rate,
+                          'byte_rate': byte_rate, 'block_align': block_align, 'bits_per_sample': bits_per_sample}
+        elif chunk_id == b'data':
+            if wav_format is not None:
+                wav_format['data_offset'] = body
+                wav_format['data_size'] = chunk_size
+            break
+        # Chunks are padded to an even number of bytes
+        position = body + chunk_size + (chunk_size & 1)
+    return wav_format
+
+
+def get_channel_count(header, media_format="wav"):
+    """
+    Reads the number of channels from the header of a wav, mp3 or flac file
+
+    :param header: The first bytes of the file, after its ID3 tag for mp3 and flac files
+    :param media_format: Transcribe media format of the file
+    :return: The number of channels, 0 if the header cannot be read or the format is not supported
+    """
+    if media_format == "mp3":
+        return read_mp3_channel_count(header)
+    if media_format == "flac":
+        return read_flac_channel_count(header)
+    if media_format != "wav":
+        return 0
+    wav_format = read_wav_format(header)
+    return wav_format['channels'] if wav_format else 0
+
+
+def id3_tag_size(header):
+    """
+    Returns the size of the ID3v2 tag that mp3 and some flac files start with, 0 if there is none.
+    The tag can hold cover art, so it can be larger than the header that was read
+    """
+    if len(header) < 10 or header[0:3] != b'ID3':
+        return 0
+    # The size is stored as four 7-bit bytes, and does not include the header or the optional footer
+    size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+    has_footer = header[5] & 0x10
+    return 10 + size + (10 if has_footer else 0)
+
+
+def read_mp3_channel_count(header):
+    """
+    Reads the number of channels from the channel mode bits of the first mp3 frame header
+
+    :param header: The first bytes of the mp3 audio, after its ID3 tag
+    :return: 1 or 2, 0 if no frame header was found
+    """
+    for position in range(len(header) - 3):
+        if header[position] != 0xFF or header[position + 1] & 0xE0 != 0xE0:
+            continue
+        version = (header[position + 1] >> 3) & 0x3
+        layer = (header[position + 1] >> 1) & 0x3
+        bitrate_index = header[position + 2] >> 4
+        sample_rate_index = (header[position + 2] >> 2) & 0x3
+        # Reserved values can only come from bytes that merely look like a frame sync
+        if version == 1 or layer == 0 or bitrate_index == 0xF or sample_rate_index == 3:
+            continue
+        return 1 if header[position + 3] >> 6 == MP3_CHANNEL_MODE_MONO else 2
+    return 0
+
+
+def read_flac_channel_count(header):
+    """
+    Reads the number of channels from the STREAMINFO block, which is always the first metadata block of a flac file
+
+    :param header: The first bytes of the flac audio, after its ID3 tag if it has one
+    :return: The number of channels, 0 if the header is not a flac header
+    """
+    # fLaC, the 4 byte metadata block header, then 10 bytes of block and frame sizes before the sample rate
+    if len(header) < 22 or header[0:4] != b'fLaC' or header[4] & 0x7F != 0:
+        return 0
+    # 20 bits of sample rate, 3 bits of channels minus one, 5 bits of bits per sample minus one
+    packed = struct.unpack_from('>I', header, 18)[0]
+    return ((packed >> 9) & 0x7) + 1
+
+
+def can_split(wav_format, free_bytes):
+    """
+    Checks if a wav recording can be read by the splitter, is long enough to be split, and if its longest
+    possible segment fits in free_bytes of local storage
+
+    :param wav_format: The wav format as returned by ``read_wav_format()``
+    :param free_bytes: Local storage available for a segment
+    :return: True if the recording should be split into segments, False otherwise
+    """
+    if wav_format is None or 'data_offset' not in wav_format or wav_format['format_tag'] != WAVE_FORMAT_PCM:
+        return False
+    if wav_format['bits_per_sample'] // 8 not in SAMPLE_WIDTH_TO_TYPECODE or not wav_format['byte_rate']:
+        return False
+    if max_segment_bytes(wav_format) > free_bytes:
+        return False
+    return recording_duration(wav_format) > SPLIT_THRESHOLD_SECONDS
+
+
+def recording_duration(wav_format):
+    """
+    Returns the length of the recording in seconds
+    """
+    return wav_format['data_size'] / wav_format['byte_rate']
+
+
+def max_segment_bytes(wav_format):
+    """
+    Returns the size of the longest segment ``plan_segments()`` can plan for the recording. The last segment
+    can be up to one and a half target segments long, and a cut can move by SILENCE_SEARCH_SECONDS
+    """
+    longest = TARGET_SEGMENT_SECONDS * 1.5 + SILENCE_SEARCH_SECONDS + OVERLAP_SECONDS
+    return int(longest * wav_format['byte_rate']) + wav_format['data_offset']
+
+
+def read_exactly(stream, size):
+    """
+    Reads size bytes from the stream, fewer only at the end of the stream
+    """
+    chunks = []
+    while size > 0:
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def window_bytes(wav_format):
+    """
+    Returns the number of bytes of audio data in one WINDOW_SECONDS window, aligned to whole frames
+    """
+    return max(1, int(wav_format['sample_rate'] * WINDOW_SECONDS)) * wav_format['block_align']
+
+
+def window_byte_range(wav_format, first_window, end_window):
+    """
+    Returns the first and last byte of the recording that hold the windows from first_window up to, but not
+    including, end_window, for a ranged S3 GET
+
+    :param wav_format: The wav format as returned by ``read_wav_format()``
+    :param first_window: Index of the first window
+    :param end_window: Index of the window after the last one, clamped to the end of the recording
+    :return: Tuple of the first and last byte offset, both inclusive
+    """
+    data_end = wav_format['data_offset'] + wav_format['data_size']
+    first = wav_format['data_offset'] + first_window * window_bytes(wav_format)
+    return first, min(data_end, wav_format['data_offset'] + end_window * window_bytes(wav_format)) - 1
+
+
+def window_energies(stream, wav_format, size=None):
+    """
+    Reads the audio data of the recording one window at a time and returns the RMS energy of every window.
+    Only one window of audio is held in memory at a time
+
+    :param stream: A stream of the recording's audio data, starting at the first sample of a window
+    :param wav_format: The wav format as returned by ``read_wav_format()``
+    :param size: Number of bytes of audio data to read, the whole data chunk by default
+    :return: List of RMS energies, one for each WINDOW_SECONDS of audio
+    """
+    sample_width = wav_format['bits_per_sample'] // 8
+    typecode = SAMPLE_WIDTH_TO_TYPECODE[sample_width]
+    # 8-bit wav samples are unsigned and centered around 128
+    bias = 128 if typecode == 'B' else 0
+    remaining = wav_format['data_size'] if size is None else size
+    energies = []
+    while remaining > 0:
+        frames = read_exactly(stream, min(window_bytes(wav_format), remaining))
+        # Drop a trailing partial sample
+        frames = frames[:len(frames) - len(frames) % sample_width]
+        if not frames:
+            break
+        remaining -= len(frames)
+        if audioop is not None:
+            if bias:
+                frames = audioop.bias(frames, 1, -bias)
+            energies.append(audioop.rms(frames, sample_width))
+            continue
+        samples = array.array(typecode, frames)
+        energies.append(math.sqrt(sum((s - bias) * (s - bias) for s in samples) / len(samples)))
+    return energies
+
+
+def find_silence(energies, target_window, search_windows):
+    """
+    Finds the quietest window within search_windows of target_window, preferring the window closest
+    to the target when several are equally quiet
+    Helper function for ``plan_segments()``
+
+    :param energies: List of window RMS energies
+    :param target_window: The index of the window where a cut would ideally happen
+    :param search_windows: The number of windows to search on either side of the target
+    :return: Index of the window to cut at
+    """
+    low = max(0, target_window - search_windows)
+    high = min(len(energies), target_window + search_windows + 1)
+    return min(range(low, high), key=lambda i: (energies[i], abs(i - target_window)))
+
+
+def plan_segments(read_energies, duration):
+    """
+    Plans the segments of a long recording. Cut points are placed at the quietest moment near every
+    TARGET_SEGMENT_SECONDS, and every segment apart from the last is extended by OVERLAP_SECONDS past its
+    cut point into the next segment. Only the SILENCE_SEARCH_SECONDS on either side of every target are read.
+    Each target follows the previous cut, so the stretches are read one after the other
+
+    :param read_energies: Function that takes the index of the first window and of the window after the last
+                          one, and returns the RMS energies of those windows like ``window_energies()``
+    :param duration: Length of the recording in seconds
+    :return: List of dicts with the 'start' and 'end' of each segment in seconds, and the 'cut' seconds
+             after which the next segment takes over
+    """
+    search_windows = int(SILENCE_SEARCH_SECONDS / WINDOW_SECONDS)
+    cuts = []
+    target = TARGET_SEGMENT_SECONDS
+    while duration - target > TARGET_SEGMENT_SECONDS / 2:
+        target_window = int(target / WINDOW_SECONDS)
+        first_window = max(0, target_window - search_windows)
+        energies = read_energies(first_window, target_window + search_windows + 1)
+        cut = (first_window + find_silence(energies, target_window - first_window, search_windows)) * \
+            WINDOW_SECONDS
+        cuts.append(cut)
+        target = cut + TARGET_SEGMENT_SECONDS
+
+    segments = []
+    start = 0.0
+    for cut in cuts:
+        segments.append({"start": start, "end": min(duration, cut + OVERLAP_SECONDS), "cut": cut})
+        start = cut
+    segments.append({"start": start, "end": duration, "cut": duration})
+    return segments
+
+
+def segment_byte_range(wav_format, segment):
+    """
+    Returns the first and last byte of the recording that hold the audio of the segment, aligned to whole frames,
+    for a ranged S3 GET
+
+    :param wav_format: The wav format as returned by ``read_wav_format()``
+    :param segment: A segment as returned by ``plan_segments()``
+    :return: Tuple of the first and last byte offset, both inclusive
+    """
+    block_align = wav_format['block_align']
+    total_frames = wav_format['data_size'] // block_align
+    start_frame = int(segment['start'] * wav_format['sample_rate'])
+    end_frame = min(total_frames, int(segment['end'] * wav_format['sample_rate']))
+    first = wav_format['data_offset'] + start_frame * block_align
+    return first, first + (end_frame - start_frame) * block_align - 1
+
+
+def write_segment(stream, wav_format, path, size):
+    """
+    Writes size bytes of audio data from the stream to a wav file with the recording's audio parameters
+
+    :param stream: A stream of the segment's audio data
+    :param wav_format: The wav format as returned by ``read_wav_format()``
+    :param path: Local path of the segment file
+    :param size: Number of bytes of audio data in the segment
+    """
+    copy_bytes = max(1, int(wav_format['byte_rate'] * WINDOW_SECONDS * 100))
+    with wave.open(path, 'wb') as out:
+        out.setnchannels(wav_format['channels'])
+        out.setsampwidth(wav_format['bits_per_sample'] // 8)
+        out.setframerate(wav_format['sample_rate'])
+        while size > 0:
+            frames = read_exactly(stream, min(copy_bytes, size))
+            if not frames:
+                break
+            out.writeframes(frames)
+            size -= len(frames)
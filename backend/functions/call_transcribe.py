@@ -1,6 +1,11 @@
 import boto3
 import os
+import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from common_lib import id_generator
+import audio_splitter
 import logging
 from botocore.config import Config
 
@@ -23,6 +28,18 @@ CONFIG = Config(
     )
 )
 TRANSCRIBE_CLIENT = boto3.client('transcribe', config=CONFIG)
+S3_CLIENT = boto3.client('s3')
+
+# Bucket that holds the segments of long recordings, splitting is disabled if it is not set
+SEGMENT_BUCKET = os.getenv('BUCKET_NAME')
+# Segment jobs started at the same time, so a long recording does not hit the Transcribe request rate at once
+SEGMENT_START_WORKERS = 4
+# Enough of an audio file to read its header and find out how long the recording is
+AUDIO_HEADER_BYTES = 65536
+# Stereo recordings put the caller and the call-taker on separate channels, so each channel is transcribed
+# on its own instead of using speaker diarization. The channels of wav, mp3 and flac recordings are read from
+# their header, mp4 recordings are always diarized
+CHANNEL_IDENTIFICATION = os.getenv('CHANNEL_IDENTIFICATION', default='TRUE')
 
 
 CONTENT_TYPE_TO_MEDIA_FORMAT = {
@@ -52,14 +69,16 @@ def lambda_handler(event, context):
     uploaded to S3
 
     :param event: Input that is passed in when `start_trigger.py` starts the step functions workflow
-    :return: A dict for the `check_transcribe.py` lambda
+    :return: A dict for the `check_transcribe.py` lambda, with a single 'transcribeJob' or, for long recordings
+             that were split, a list of segment jobs in 'transcribeJobs'
     """
 
     # Default to unsuccessful
     is_successful = "FALSE"
 
-    # Create a random name for the transcription job
-    jobname = id_generator()
+    # Name the transcription job after the step functions execution, so a retried step finds the jobs it
+    # already started instead of starting them again. Fall back to a random name outside of step functions
+    jobname = job_name_for_execution(event.get('executionName') or id_generator())
 
     # Extract the bucket and key
     bucket = event['bucketName']
@@ -72,17 +91,70 @@ def lambda_handler(event, context):
     media_format = CONTENT_TYPE_TO_MEDIA_FORMAT[content_type]
     LOGGER.info(f"media type: {content_type}")
 
+    channel_identification = False
+    is_long = False
+    wav_format = None
+    if media_format in ("wav", "mp3", "flac"):
+        header = read_audio_header(bucket, key)
+        tag_size = audio_splitter.id3_tag_size(header)
+        if media_format != "wav" and tag_size:
+            header = read_audio_header(bucket, key, tag_size)
+        channel_identification = CHANNEL_IDENTIFICATION == 'TRUE' and \
+            audio_splitter.get_channel_count(header, media_format) == 2
+    if media_format == "wav":
+        wav_format = audio_splitter.read_wav_format(header)
+        # Recordings whose segments would not fit in /tmp are transcribed as a single job
+        is_long = SEGMENT_BUCKET is not None and \
+            audio_splitter.can_split(wav_format, shutil.disk_usage(tempfile.gettempdir()).free)
+    LOGGER.info(f"channel identification: {channel_identification}")
+
+    # Long wav recordings are split at silences and every segment is transcribed by its own job in parallel
+    if is_long:
+        return {
+            "success": "TRUE",
+            "channelIdentification": channel_identification,
+            "transcribeJobs": start_segment_jobs(bucket, key, jobname, media_format, channel_identification,
+                                                 wav_format)
+        }
+
     # Assemble the url for the object for transcribe. It must be an s3 url in the region
     url = f"https://s3-{REGION}.amazonaws.com/{bucket}/{key}"
+    start_job(jobname, media_format, url, channel_identification)
+    is_successful = "TRUE"
+
+    # Return the transcription job and the success code only if there are no errors in the transcription request
+    return {
+        "success": is_successful,
+        "channelIdentification": channel_identification,
+        "transcribeJob": jobname
+    }
 
+
+def start_job(jobname, media_format, url, channel_identification):
+    """
+    Starts a single Transcribe job with PII redaction for the audio at url. The speakers are told apart by
+    channel identification for stereo recordings and by speaker labels otherwise
+
+    :param jobname: Name of the transcription job
+    :param media_format: Transcribe media format of the audio
+    :param url: S3 url of the audio
+    :param channel_identification: True to transcribe each channel separately instead of diarization
+    :return: The response of start_transcription_job
+    """
     try:
-        settings = {
-            'ShowSpeakerLabels': True,
-            'MaxSpeakerLabels': 2
-        }
+        # Transcribe does not allow speaker labels and channel identification in the same job
+        if channel_identification:
+            settings = {
+                'ChannelIdentification': True
+            }
+        else:
+            settings = {
+                'ShowSpeakerLabels': True,
+                'MaxSpeakerLabels': 2
+            }
 
         # Call the AWS SDK to initiate the transcription job.
-        response = TRANSCRIBE_CLIENT.start_transcription_job(
+        return TRANSCRIBE_CLIENT.start_transcription_job(
             TranscriptionJobName=jobname,
             LanguageCode='en-US',
             Settings=settings,
@@ -95,8 +167,11 @@ def lambda_handler(event, context):
                 'RedactionOutput': 'redacted'
             }
         )
-        is_successful = "TRUE"
 
+    except TRANSCRIBE_CLIENT.exceptions.ConflictException as e:
+        # The job was already started by an earlier attempt of this step
+        LOGGER.info(f"{jobname} already exists: {e}")
+        return None
     except TRANSCRIBE_CLIENT.exceptions.BadRequestException as e:
         # Issues in the configuration of the transcribe request
         LOGGER.error(str(e))
@@ -110,8 +185,69 @@ def lambda_handler(event, context):
         LOGGER.error(str(e))
         raise TranscribeException(e)
 
-    # Return the transcription job and the success code only if there are no errors in the transcription request
-    return {
-        "success": is_successful,
-        "transcribeJob": jobname
-    }
+
+def job_name_for_execution(execution_name):
+    """
+    Turns a step functions execution name into a valid Transcribe job name
+    """
+    return re.sub(r'[^0-9a-zA-Z._-]', '-', execution_name)
+
+
+def read_audio_header(bucket, key, offset=0):
+    """
+    Reads only the header of the audio file in S3, which holds the channel count of the recording and, for wav
+    files, its length. The header starts at offset bytes, after the ID3 tag of mp3 and flac files
+    """
+    response = S3_CLIENT.get_object(Bucket=bucket, Key=key,
+                                    Range=f"bytes={offset}-{offset + AUDIO_HEADER_BYTES - 1}")
+    return response['Body'].read()
+
+
+def start_segment_jobs(bucket, key, jobname, media_format, channel_identification, wav_format):
+    """
+    Splits the wav file into overlapping segments at silence boundaries, uploads the segments to the
+    SEGMENT_BUCKET and starts a Transcribe job for every segment concurrently.
+    Only the audio around every planned cut is fetched to find the silences, and every segment is fetched
+    with a ranged GET, so only the segments being uploaded are ever stored in /tmp
+
+    :param bucket: Bucket of the uploaded audio file
+    :param key: Key of the uploaded audio file
+    :param jobname: Name shared by the segment jobs, suffixed by the segment number
+    :param media_format: Transcribe media format of the audio
+    :param channel_identification: True to transcribe each channel separately instead of diarization
+    :param wav_format: The wav format of the recording as returned by ``audio_splitter.read_wav_format()``
+    :return: A list with the job name, 'start', 'end' and 'cut' of every segment for `check_transcribe.py`
+    """
+    def read_energies(first_window, end_window):
+        first, last = audio_splitter.window_byte_range(wav_format, first_window, end_window)
+        response = S3_CLIENT.get_object(Bucket=bucket, Key=key, Range=f"bytes={first}-{last}")
+        return audio_splitter.window_energies(response['Body'], wav_format, last - first + 1)
+
+    segments = audio_splitter.plan_segments(read_energies, audio_splitter.recording_duration(wav_format))
+    LOGGER.info(f"split {key} into {len(segments)} segments")
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        # Every worker keeps one segment in /tmp at a time
+        fitting_segments = shutil.disk_usage(work_dir).free // audio_splitter.max_segment_bytes(wav_format)
+        workers = max(1, min(SEGMENT_START_WORKERS, len(segments), fitting_segments))
+
+        def upload_and_start(index):
+            first, last = audio_splitter.segment_byte_range(wav_format, segments[index])
+            segment_path = os.path.join(work_dir, f"segment_{index:03d}.wav")
+            segment_response = S3_CLIENT.get_object(Bucket=bucket, Key=key, Range=f"bytes={first}-{last}")
+            audio_splitter.write_segment(segment_response['Body'], wav_format, segment_path, last - first + 1)
+
+            segment_key = f"calls/segments/{jobname}/{os.path.basename(segment_path)}"
+            S3_CLIENT.upload_file(segment_path, SEGMENT_BUCKET, segment_key)
+            os.remove(segment_path)
+
+            segment_jobname = f"{jobname}-seg{index:03d}"
+            start_job(segment_jobname, media_format,
+                      f"https://s3-{REGION}.amazonaws.com/{SEGMENT_BUCKET}/{segment_key}", channel_identification)
+            return dict(segments[index], transcribeJob=segment_jobname, segmentKey=segment_key)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(upload_and_start, range(len(segments))))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -14,12 +14,18 @@ def lambda_handler(event, context):
     if not, it runs again to check after 60 seconds.
     If the Transcribe Job has finished, it returns the Transcribe url whose payload can be read to retrieve
     the audio transcript with personal information redacted
+    Long recordings that were split are only COMPLETED once the jobs of all segments are, and return a
+    transcription url for every segment instead
 
 
     :param event: All the event variables inside a dictionary
     :return: An transcription job results in event['transcribeUrl']
     """
-    transcribe_job = event['callTranscribeResult']['transcribeJob']
+    call_transcribe_result = event['callTranscribeResult']
+    if 'transcribeJobs' in call_transcribe_result:
+        return check_segment_jobs(call_transcribe_result['transcribeJobs'])
+
+    transcribe_job = call_transcribe_result['transcribeJob']
 
     # Call the AWS SDK to get the status of the transcription job
     response = TRANSCRIBE_CLIENT.get_transcription_job(TranscriptionJobName=transcribe_job)
@@ -38,3 +44,37 @@ def lambda_handler(event, context):
         retval["transcriptionUrl"] = response['TranscriptionJob']['Transcript']['RedactedTranscriptFileUri']
 
     return retval
+
+
+def check_segment_jobs(segment_jobs):
+    """
+    Checks the status of the Transcribe jobs of every segment of a split recording
+
+    :param segment_jobs: List of segment jobs as returned by `call_transcribe.py`
+    :return: COMPLETED with a transcription url for every segment if all jobs are completed, FAILED if any job
+             failed, IN_PROGRESS otherwise
+    """
+    segment_urls = []
+    status = 'COMPLETED'
+    for segment in segment_jobs:
+        response = TRANSCRIBE_CLIENT.get_transcription_job(TranscriptionJobName=segment['transcribeJob'])
+        segment_status = response['TranscriptionJob']['TranscriptionJobStatus']
+        if segment_status == 'FAILED':
+            LOGGER.error(f"segment job {segment['transcribeJob']} failed")
+            return {"status": segment_status}
+        if segment_status != 'COMPLETED':
+            status = segment_status
+            continue
+        segment_urls.append({
+            "transcriptionUrl": response['TranscriptionJob']['Transcript']['RedactedTranscriptFileUri'],
+            "start": segment['start'],
+            "end": segment['end'],
+            "cut": segment['cut']
+        })
+
+    retval = {
+        "status": status
+    }
+    if status == 'COMPLETED':
+        retval["segmentTranscriptionUrls"] = segment_urls
+    return retval
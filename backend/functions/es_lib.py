@@ -0,0 +1,143 @@
+import boto3
+import certifi
+import json
+import logging
+import os
+import time
+from aws_requests_auth.aws_auth import AWSRequestsAuth
+from elasticsearch import Elasticsearch, RequestsHttpConnection
+
+"""
+Contains helper functions only, not a lambda function file
+Shared Elasticsearch client and call document helpers, used by the indexing lambda functions and by
+`process_transcription_full_text.py` in progressive indexing mode
+"""
+
+LOGGER = logging.getLogger()
+
+# Parameters
+REGION = os.getenv('AWS_REGION', default='us-east-1')
+
+# Pull environment data for the ES domain
+ES_ENDPOINT = os.environ['ES_DOMAIN']
+
+# get the Elasticsearch index name from the environment variables
+ES_INDEX = os.getenv('ES_INDEX', default='transcripts')
+# Values of the enrichment_status field, which tells clients if the key phrases of a call are indexed yet
+ENRICHMENT_PENDING = 'PENDING'
+ENRICHMENT_COMPLETE = 'COMPLETE'
+ENRICHMENT_FAILED = 'FAILED'
+# In progressive indexing mode the transcript is indexed before Amazon Comprehend runs, and the key phrases
+# are added to the same document once they are extracted. An event can turn it off with "progressiveIndexing": false,
+# which batch imports do so their transcripts are bulk indexed at the end of the batch
+PROGRESSIVE_INDEXING = os.getenv('PROGRESSIVE_INDEXING', default='FALSE')
+# Marks the enrichment of a document as failed only while it is pending, so the key phrases of an earlier
+# complete run are never wiped
+FAIL_PENDING_ENRICHMENT_SCRIPT = (
+    "if (ctx._source.enrichment_status == params.pending) {"
+    " ctx._source.key_phrases = []; ctx._source.enrichment_status = params.failed"
+    " } else { ctx.op = 'noop' }"
+)
+
+# Create the auth token for the sigv4 signature
+SESSION = boto3.session.Session()
+CREDENTIALS = SESSION.get_credentials().get_frozen_credentials()
+AWS_AUTH = AWSRequestsAuth(
+    aws_access_key=CREDENTIALS.access_key,
+    aws_secret_access_key=CREDENTIALS.secret_key,
+    aws_token=CREDENTIALS.token,
+    aws_host=ES_ENDPOINT,
+    aws_region=REGION,
+    aws_service='es'
+)
+
+# Connect to the elasticsearch cluster using aws authentication. The lambda function
+# must have access in an IAM policy to the ES cluster.
+ES_CLIENT = Elasticsearch(
+    hosts=[{'host': ES_ENDPOINT, 'port': 443}],
+    http_auth=AWS_AUTH,
+    use_ssl=True,
+    verify_certs=True,
+    ca_certs=certifi.where(),
+    timeout=120,
+    connection_class=RequestsHttpConnection
+)
+
+
+def is_progressive(event):
+    """
+    Tells if the call of the state machine input is indexed progressively. The event's 'progressiveIndexing'
+    flag takes precedence over the PROGRESSIVE_INDEXING environment variable
+    """
+    return event.get('progressiveIndexing', PROGRESSIVE_INDEXING == 'TRUE')
+
+
+def build_document(event, full_call_transcript, enrichment_status=ENRICHMENT_COMPLETE):
+    """
+    Builds the Elasticsearch document of a call from its metadata and processed transcript
+    """
+    s3_location = "s3://" + event['bucketName'] + "/" + event['bucketKey']
+
+    # Metadata of the processed transcript that is indexed in elasticsearch
+    doc = {
+        'audio_type': event['fileType'],
+        'name': event['fileName'],
+        'jurisdiction': event['jurisdiction'],
+        'description': event['description'],
+        'procedure': event['procedure'],
+        'audio_s3_location': s3_location,
+        'transcript':  full_call_transcript['transcript'],
+        'key_phrases': full_call_transcript['key_phrases'],
+        'enrichment_status': enrichment_status
+    }
+    return doc
+
+
+def index_partial_transcript(event, transcript):
+    """
+    First phase of progressive indexing. Indexes the speaker labelled transcript and metadata of a call before
+    its key phrases are extracted, so the call is searchable as early as possible
+
+    :param event: The state machine input with the call metadata
+    :param transcript: The speaker labelled transcript
+    """
+    doc = build_document(event, {'transcript': transcript, 'key_phrases': []}, ENRICHMENT_PENDING)
+
+    start = time.time()
+    res = ES_CLIENT.index(index=ES_INDEX, body=doc, id=event['dynamoId'])
+    LOGGER.info(json.dumps(res, indent=4))
+    LOGGER.info('REQUEST_TIME es_client.index {:10.4f}'.format(time.time() - start))
+
+
+def update_enrichment(dynamo_id, key_phrases, enrichment_status):
+    """
+    Second phase of progressive indexing. Patches the key phrases and the enrichment status into the document
+    indexed by ``index_partial_transcript()`` with a partial update, leaving the rest of the document untouched
+
+    :param dynamo_id: Id of the call document
+    :param key_phrases: The extracted key phrases
+    :param enrichment_status: ENRICHMENT_COMPLETE, or ENRICHMENT_FAILED if the key phrases could not be extracted
+    """
+    start = time.time()
+    res = ES_CLIENT.update(index=ES_INDEX, id=dynamo_id,
+                           body={'doc': {'key_phrases': key_phrases, 'enrichment_status': enrichment_status}})
+    LOGGER.info(json.dumps(res, indent=4))
+    LOGGER.info('REQUEST_TIME es_client.update {:10.4f}'.format(time.time() - start))
+
+
+def fail_pending_enrichment(dynamo_id):
+    """
+    Sets the enrichment status of a call document to FAILED and clears its key phrases, but only if the
+    enrichment is still PENDING. The check and the update run as one scripted update in Elasticsearch
+
+    :param dynamo_id: Id of the call document
+    :return: True if the document was marked as failed, False if its enrichment was not pending
+    """
+    start = time.time()
+    res = ES_CLIENT.update(index=ES_INDEX, id=dynamo_id,
+                           body={'script': {'source': FAIL_PENDING_ENRICHMENT_SCRIPT, 'lang': 'painless',
+                                            'params': {'pending': ENRICHMENT_PENDING,
+                                                       'failed': ENRICHMENT_FAILED}}})
+    LOGGER.info(json.dumps(res, indent=4))
+    LOGGER.info('REQUEST_TIME es_client.update {:10.4f}'.format(time.time() - start))
+    return res['result'] == 'updated'
@@ -3,8 +3,12 @@ import os
 import logging
 import time
 import json
+import heapq
 from urllib.request import urlopen
 from common_lib import id_generator
+from transcript_stitcher import stitch_results
+from es_lib import index_partial_transcript, is_progressive, update_enrichment, ENRICHMENT_COMPLETE, \
+    ENRICHMENT_FAILED
 
 # Logging configurations
 logging.basicConfig()
@@ -30,28 +34,74 @@ S3_CLIENT = boto3.client("s3")
 COMPREHEND_CLIENT = boto3.client(service_name='comprehend', region_name=REGION)
 
 
-def process_transcript(transcription_url, vocabulary_info):
+def read_transcription_results(transcription_url):
     """
-    Processes the transcript and returns the S3 bucket URI of processed transcript
+    Reads the Transcribe result json behind the signed transcription_url
 
     :param transcription_url: A signed url that contains the audio transcription result from Transcribe
-    :param vocabulary_info: Custom vocabulary for transcription if implemented
-    :return: A dict containing the bucket location for the transcribed text
+    :return: The 'results' of the Transcribe result
     """
-    custom_vocabs = None
-
-    # Read Transcribe result url
     response = urlopen(transcription_url)
     output = response.read()
     json_data = json.loads(output)
 
     LOGGER.debug(json.dumps(json_data, indent=4))
-    results = json_data['results']
-    # free up memory
-    del json_data
+    return json_data['results']
+
+
+def read_segment_results(segment_urls):
+    """
+    Reads the Transcribe results of every segment of a split recording and stitches them into one result
+
+    :param segment_urls: List of dicts with the 'transcriptionUrl', 'start', 'end' and 'cut' of every segment
+    :return: Transcribe results for the whole recording
+    """
+    start = time.time()
+    segment_results = [dict(segment, results=read_transcription_results(segment['transcriptionUrl']))
+                       for segment in segment_urls]
+    results = stitch_results(segment_results)
+    LOGGER.info('Stitched {} segments. Took time {:10.4f}\n'.format(len(segment_urls), time.time() - start))
+    return results
+
+
+def process_transcript(results, vocabulary_info, event):
+    """
+    Processes the transcript and returns the S3 bucket URI of processed transcript
+    In progressive indexing mode the transcript is indexed right after it is chunked up, then the key phrases
+    are patched into the document and nothing is written to S3
+
+    :param results: The 'results' of the audio transcription from Transcribe
+    :param vocabulary_info: Custom vocabulary for transcription if implemented
+    :param event: The state machine input with the call metadata
+    :return: A dict containing the bucket location for the transcribed text, or whether the call was indexed
+             in progressive indexing mode
+    """
+    custom_vocabs = None
 
     comprehend_text, speaker_labelled_paragraphs = chunk_up_transcript(custom_vocabs, results)
 
+    if not is_progressive(event):
+        key_phrases = extract_key_phrases(comprehend_text)
+        return write_transcript(speaker_labelled_paragraphs, key_phrases)
+
+    index_partial_transcript(event, speaker_labelled_paragraphs)
+    try:
+        key_phrases = extract_key_phrases(comprehend_text)
+    except Exception:
+        # Keep the searchable transcript, but let clients know the key phrases will not arrive
+        update_enrichment(event['dynamoId'], [], ENRICHMENT_FAILED)
+        raise
+    update_enrichment(event['dynamoId'], key_phrases, ENRICHMENT_COMPLETE)
+    return {"indexed": True}
+
+
+def extract_key_phrases(comprehend_text):
+    """
+    Extracts the key phrases, adjectives and verbs of the transcript with Amazon Comprehend
+
+    :param comprehend_text: Chunks of the transcript as returned by ``chunk_up_transcript()``
+    :return: A list of key phrases
+    """
     start = time.time()
     detected_phrase_response = COMPREHEND_CLIENT.batch_detect_key_phrases(TextList=comprehend_text, LanguageCode='en')
     round_trip = time.time() - start
@@ -69,7 +119,17 @@ def process_transcript(transcription_url, vocabulary_info):
 
     key_phrases.extend(extra_keywords)
     LOGGER.info(f"Final keyphrases:{key_phrases}")
+    return key_phrases
 
+
+def write_transcript(speaker_labelled_paragraphs, key_phrases):
+    """
+    Stores the processed transcript in the S3 bucket for `upload_to_elasticsearch.py`
+
+    :param speaker_labelled_paragraphs: The speaker labelled transcript
+    :param key_phrases: The extracted key phrases
+    :return: A dict containing the bucket location for the transcribed text
+    """
     doc_to_update = {'transcript': speaker_labelled_paragraphs, 'key_phrases': key_phrases}
     LOGGER.debug(json.dumps(doc_to_update, indent=4))
 
@@ -104,13 +164,18 @@ def chunk_up_transcript(custom_vocabs, results):
     # https://github.com/kibaffo33/aws_transcribe_to_docx/tree/master/sample_material
 
     speaker_label_exist = False
-    speaker_segments = None
-    # If the transcription has speaker labels, parse the individual segments of speech into a list
-    if 'speaker_labels' in results:
+    # If the transcription used channel identification, every channel is already attributed to one speaker
+    # and the channels only have to be merged by time.
+    # Else if the transcription has speaker labels, parse the individual segments of speech into a list
+    if 'channel_labels' in results:
+        speaker_label_exist = True
+        labelled_units = merge_channel_items(results)
+    elif 'speaker_labels' in results:
         speaker_label_exist = True
-        speaker_segments = parse_speaker_segments(results)
+        labelled_units = label_items_by_speaker(results['items'], parse_speaker_segments(results))
+    else:
+        labelled_units = ((item, None) for item in results['items'])
 
-    transcribed_units = results['items']
     last_speaker = None
     speaker_labelled_paragraphs = []
     current_paragraph = ""
@@ -119,7 +184,7 @@ def chunk_up_transcript(custom_vocabs, results):
     previous_item_end_time = 0
     current_speaker_start_time = 0
     last_item_was_sentence_end = False
-    for item in transcribed_units:
+    for item, current_speaker in labelled_units:
         # If the item is a word, parse, replace with vocabulary if applicable and chunk it up
         if item["type"] == "pronunciation":
             current_item_start_time = float(item['start_time'])
@@ -127,7 +192,6 @@ def chunk_up_transcript(custom_vocabs, results):
             # If the speaker has changed, append the aggregated transcribed words so far,
             # reset current_paragraph with the name of the new speaker, and note the time when speaker changed
             if speaker_label_exist:
-                current_speaker = get_speaker_label(speaker_segments, float(item['start_time']))
                 if last_speaker is None or current_speaker != last_speaker:
                     if current_paragraph is not None:
                         speaker_labelled_paragraphs.append(current_paragraph)
@@ -275,6 +339,53 @@ def parse_speaker_segments(results):
     return speaker_segments
 
 
+def label_items_by_speaker(transcribed_units, speaker_segments):
+    """
+    Pairs every Transcribe item with the speaker label of the segment it was spoken in.
+    Punctuation items have no time stamp and are not labelled
+    Helper function for ``chunk_up_transcript()``
+
+    :param transcribed_units: The 'items' of the Amazon Transcribe results
+    :param speaker_segments: List of speaker segments
+    :return: Generator of (item, speaker label) tuples
+    """
+    for item in transcribed_units:
+        if item["type"] == "pronunciation":
+            yield item, get_speaker_label(speaker_segments, float(item['start_time']))
+        else:
+            yield item, None
+
+
+def merge_channel_items(results):
+    """
+    Merges the items of every channel of a channel identification transcript into a single stream ordered
+    by time. Every channel has already been attributed to one speaker, so each item is labelled with its
+    channel label. The channel streams are sorted by time, so a k-way merge is enough
+    Helper function for ``chunk_up_transcript()``
+
+    :param results: Amazon Transcribe results JSON with 'channel_labels'
+    :return: Generator of (item, channel label) tuples
+    """
+    def channel_units(channel):
+        # Punctuation has no time stamp, so it travels with the word before it
+        label = channel['channel_label']
+        unit = None
+        for item in channel['items']:
+            if item["type"] == "pronunciation":
+                if unit is not None:
+                    yield unit
+                unit = (float(item['start_time']), label, [item])
+            elif unit is not None:
+                unit[2].append(item)
+        if unit is not None:
+            yield unit
+
+    streams = [channel_units(channel) for channel in results['channel_labels']['channels']]
+    for _, label, items in heapq.merge(*streams, key=lambda unit: unit[0]):
+        for item in items:
+            yield item, label
+
+
 def get_speaker_label(speaker_segments, time_stamp):
     """
     Performs a linear search for the associated speaker for a given time_stamp
@@ -303,12 +414,17 @@ def lambda_handler(event, context):
     LOGGER.info('Received transcription url')
     LOGGER.info(json.dumps(event))
 
-    # Pull the signed URL for the payload of the transcription job
-    transcription_url = event['checkTranscribeResult']['transcriptionUrl']
+    # Pull the signed URL for the payload of the transcription job, or of every segment job
+    # if the recording was split
+    check_transcribe_result = event['checkTranscribeResult']
+    if 'segmentTranscriptionUrls' in check_transcribe_result:
+        results = read_segment_results(check_transcribe_result['segmentTranscriptionUrls'])
+    else:
+        results = read_transcription_results(check_transcribe_result['transcriptionUrl'])
 
     # NOTE: Custom vocabulary may be inserted here
     vocab_info = None
 
     if 'vocabularyInfo' in event:
         vocab_info = event['vocabularyInfo']
-    return process_transcript(transcription_url, vocab_info)
+    return process_transcript(results, vocab_info, event)
@@ -0,0 +1,280 @@
+import boto3
+import logging
+import os
+import re
+import time
+from common_lib import id_generator
+
+logging.basicConfig()
+LOGGER = logging.getLogger()
+if os.getenv('LOG_LEVEL') == 'DEBUG':
+    LOGGER.setLevel(logging.DEBUG)
+else:
+    LOGGER.setLevel(logging.INFO)
+
+SQS_CLIENT = boto3.client('sqs')
+STEPFUNCTIONS_CLIENT = boto3.client('stepfunctions')
+CLOUDWATCH_CLIENT = boto3.client('cloudwatch')
+TRANSCRIBE_CLIENT = boto3.client('transcribe')
+
+STEPFUNCTIONS_ARN = os.environ['STEP_FUNCTION_ARN']
+BATCH_STEP_FUNCTION_ARN = os.getenv('BATCH_STEP_FUNCTION_ARN')
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+LANES = (INTERACTIVE, BULK)
+# The items of running batch imports, which share the bulk capacity with the bulk lane
+BATCH = "batch"
+LANE_QUEUE_URLS = {
+    INTERACTIVE: os.environ['INTERACTIVE_QUEUE_URL'],
+    BULK: os.environ['BULK_QUEUE_URL']
+}
+# Share of the free capacity each lane and the batch imports get per dequeuing round when several have waiting calls
+LANE_WEIGHTS = {
+    INTERACTIVE: int(os.getenv('INTERACTIVE_WEIGHT', default='4')),
+    BULK: int(os.getenv('BULK_WEIGHT', default='1')),
+    BATCH: int(os.getenv('BATCH_WEIGHT', default='1'))
+}
+# Calls transcribed and processed at the same time, across both lanes and batch imports. A split recording counts
+# once for every segment it is transcribing, so keep it below the concurrent Transcribe job quota of the account
+MAX_RUNNING = int(os.getenv('MAX_RUNNING_EXECUTIONS', default='50'))
+# Capacity that bulk work may never use, so a fresh upload never waits behind a backfill
+INTERACTIVE_RESERVED = int(os.getenv('INTERACTIVE_RESERVED', default='10'))
+METRIC_NAMESPACE = os.getenv('METRIC_NAMESPACE', default='CallTranscriptIndexer')
+# Long poll of every receive. A short poll only samples some of the SQS servers and often comes back empty on a
+# small queue, which would leave a waiting call for the next scheduled run
+RECEIVE_WAIT_SECONDS = int(os.getenv('RECEIVE_WAIT_SECONDS', default='1'))
+# `call_transcribe.py` names the job of every segment of a split recording after its execution with this suffix
+SEGMENT_JOB_SUFFIX = re.compile(r'-seg\d{3}$')
+
+
+def lambda_handler(event, context):
+    """
+    Dispatches waiting calls from the interactive and bulk queues into the transcription state machine.
+    Invoked every minute and by `start_trigger.py` whenever a call is queued.
+    Free capacity is shared between the lanes and the pending items of running batch imports by weighted fair
+    dequeuing, and bulk work, which is the bulk lane and the batch imports, is kept out of the capacity reserved
+    for interactive calls. Batch imports get their share by raising the max concurrency of their map runs.
+    Queue depth, wait time and running executions are published as CloudWatch metrics
+
+    :param event: Not used
+    :return: The number of calls started from each lane
+    """
+    running = count_running_executions()
+    map_runs = list_running_map_runs()
+    depths = {lane: queue_depth(lane) for lane in LANES}
+    running[BATCH] = sum(map_run['running'] for map_run in map_runs)
+    depths[BATCH] = sum(map_run['pending'] for map_run in map_runs)
+    for lane, extra_jobs in count_segment_fan_out().items():
+        running[lane] += extra_jobs
+
+    planned = plan_lanes(running, depths)
+    started = {}
+    wait_times = {}
+    for lane in LANES:
+        started[lane], wait_times[lane] = start_from_lane(lane, planned[lane])
+    started[BATCH] = throttle_map_runs(map_runs, planned[BATCH])
+
+    LOGGER.info(f"running: {running}, depths: {depths}, started: {started}")
+    publish_metrics(depths, started, wait_times, running)
+    return started
+
+
+def plan_lanes(running, depths):
+    """
+    Plans how many calls to start from each lane and how many batch items to let start, so that no more than
+    MAX_RUNNING run at the same time. Bulk work, which is the bulk lane and the batch imports, may only use the
+    capacity that is neither reserved for nor wanted by interactive calls
+
+    :param running: Dict of running executions per lane and for the batch imports, segment jobs included
+    :param depths: Dict of waiting calls per lane and pending items of the batch imports
+    :return: Dict of executions to start per lane and batch items to let start
+    """
+    # Bulk work may only use the capacity that is neither reserved for nor wanted by interactive calls
+    interactive_demand = running[INTERACTIVE] + depths[INTERACTIVE]
+    bulk_capacity = max(0, MAX_RUNNING - max(INTERACTIVE_RESERVED, interactive_demand))
+    free = max(0, MAX_RUNNING - sum(running.values()))
+    # The bulk lane and the batch imports first split the bulk capacity between them by their weights, so
+    # together they never go over it, then compete with the interactive lane for the free capacity
+    bulk_free = max(0, min(free, bulk_capacity - running[BULK] - running[BATCH]))
+    bulk_limits = plan_dequeue(bulk_free, {BULK: depths[BULK], BATCH: depths[BATCH]}, LANE_WEIGHTS,
+                               {BULK: bulk_free, BATCH: bulk_free})
+    limits = {
+        INTERACTIVE: free,
+        BULK: bulk_limits[BULK],
+        BATCH: bulk_limits[BATCH]
+    }
+
+    return plan_dequeue(free, depths, LANE_WEIGHTS, limits)
+
+
+def plan_dequeue(free, depths, weights, limits):
+    """
+    Plans how many calls to start from each lane with weighted round robin. In every round each lane gets up to
+    its weight in slots, as long as it has waiting calls and has not reached its limit, so no lane starves
+    and idle capacity of one lane is used by the others
+
+    :param free: Number of executions that can be started
+    :param depths: Dict of waiting calls per lane
+    :param weights: Dict of slots per round per lane
+    :param limits: Dict of the most executions each lane may start
+    :return: Dict of executions to start per lane
+    """
+    planned = {lane: 0 for lane in depths}
+    while free > 0:
+        progress = False
+        for lane in depths:
+            share = min(weights[lane], free, depths[lane] - planned[lane], limits[lane] - planned[lane])
+            if share > 0:
+                planned[lane] += share
+                free -= share
+                progress = True
+        if not progress:
+            break
+    return planned
+
+
+def start_from_lane(lane, count):
+    """
+    Receives up to count waiting calls from the lane's queue and starts a state machine execution for each of them.
+    The execution name starts with the lane, which is how running executions are counted per lane
+
+    :param lane: INTERACTIVE or BULK
+    :param count: The number of calls to start
+    :return: The number of started executions, and the seconds every started call waited in the queue
+    """
+    started = 0
+    wait_times = []
+    while started < count:
+        response = SQS_CLIENT.receive_message(QueueUrl=LANE_QUEUE_URLS[lane],
+                                              MaxNumberOfMessages=min(10, count - started),
+                                              AttributeNames=['SentTimestamp'],
+                                              WaitTimeSeconds=RECEIVE_WAIT_SECONDS)
+        messages = response.get('Messages', [])
+        if not messages:
+            break
+        for message in messages:
+            STEPFUNCTIONS_CLIENT.start_execution(
+                stateMachineArn=STEPFUNCTIONS_ARN,
+                name=f"{lane}-{id_generator(size=12)}",
+                input=message['Body']
+            )
+            SQS_CLIENT.delete_message(QueueUrl=LANE_QUEUE_URLS[lane], ReceiptHandle=message['ReceiptHandle'])
+            wait_times.append(time.time() - int(message['Attributes']['SentTimestamp']) / 1000)
+            started += 1
+    return started, wait_times
+
+
+def queue_depth(lane):
+    """
+    Returns the approximate number of calls waiting in the lane's queue
+    """
+    response = SQS_CLIENT.get_queue_attributes(QueueUrl=LANE_QUEUE_URLS[lane],
+                                               AttributeNames=['ApproximateNumberOfMessages'])
+    return int(response['Attributes']['ApproximateNumberOfMessages'])
+
+
+def count_running_executions():
+    """
+    Counts the running executions of the transcription state machine per lane.
+    Executions started directly, without a lane prefix, are counted as interactive
+    """
+    running = {lane: 0 for lane in LANES}
+    paginator = STEPFUNCTIONS_CLIENT.get_paginator('list_executions')
+    for page in paginator.paginate(stateMachineArn=STEPFUNCTIONS_ARN, statusFilter='RUNNING'):
+        for execution in page['executions']:
+            lane = BULK if execution['name'].startswith(f"{BULK}-") else INTERACTIVE
+            running[lane] += 1
+    return running
+
+
+def count_segment_fan_out():
+    """
+    Counts the Transcribe jobs that split recordings run on top of the one job of their execution, per lane.
+    The segment jobs of a recording run at the same time, so a split recording uses one slot of the Transcribe
+    job quota per segment. Segment jobs are named after their execution, whose name starts with its lane
+
+    :return: Dict of extra Transcribe jobs per lane and for the batch imports
+    """
+    jobs_per_execution = {}
+    for status in ('QUEUED', 'IN_PROGRESS'):
+        kwargs = {'Status': status, 'JobNameContains': '-seg', 'MaxResults': 100}
+        while True:
+            response = TRANSCRIBE_CLIENT.list_transcription_jobs(**kwargs)
+            for job in response['TranscriptionJobSummaries']:
+                if SEGMENT_JOB_SUFFIX.search(job['TranscriptionJobName']):
+                    execution = SEGMENT_JOB_SUFFIX.sub('', job['TranscriptionJobName'])
+                    jobs_per_execution[execution] = jobs_per_execution.get(execution, 0) + 1
+            if 'NextToken' not in response:
+                break
+            kwargs['NextToken'] = response['NextToken']
+
+    fan_out = {lane: 0 for lane in (INTERACTIVE, BULK, BATCH)}
+    for execution, jobs in jobs_per_execution.items():
+        lane = next((lane for lane in (BULK, BATCH) if execution.startswith(f"{lane}-")), INTERACTIVE)
+        fan_out[lane] += jobs - 1
+    return fan_out
+
+
+def list_running_map_runs():
+    """
+    Lists the distributed map runs of the running batch imports with the number of items each is processing
+
+    :return: List of dicts with the 'mapRunArn', the number of 'running' and 'pending' items and the
+             current 'maxConcurrency'
+    """
+    map_runs = []
+    if not BATCH_STEP_FUNCTION_ARN:
+        return map_runs
+    paginator = STEPFUNCTIONS_CLIENT.get_paginator('list_executions')
+    for page in paginator.paginate(stateMachineArn=BATCH_STEP_FUNCTION_ARN, statusFilter='RUNNING'):
+        for execution in page['executions']:
+            response = STEPFUNCTIONS_CLIENT.list_map_runs(executionArn=execution['executionArn'])
+            for map_run in response['mapRuns']:
+                if 'stopDate' in map_run:
+                    continue
+                details = STEPFUNCTIONS_CLIENT.describe_map_run(mapRunArn=map_run['mapRunArn'])
+                map_runs.append({"mapRunArn": map_run['mapRunArn'],
+                                 "running": details['itemCounts']['running'],
+                                 "pending": details['itemCounts']['pending'],
+                                 "maxConcurrency": details['maxConcurrency']})
+    return map_runs
+
+
+def throttle_map_runs(map_runs, count):
+    """
+    Lets the running batch imports start count more items, shared evenly between their map runs, by setting the
+    max concurrency of every map run to its running items plus its share. Items already running are never
+    stopped, a map run only starts new items while it is below its max concurrency. Every map run keeps at
+    least one slot so it keeps progressing
+
+    :param map_runs: Map runs as returned by ``list_running_map_runs()``
+    :param count: The number of batch items planned to start
+    :return: The number of batch items the map runs were allowed to start
+    """
+    pending = {map_run['mapRunArn']: map_run['pending'] for map_run in map_runs}
+    shares = plan_dequeue(count, pending, {arn: 1 for arn in pending}, pending)
+    for map_run in map_runs:
+        max_concurrency = max(1, map_run['running'] + shares[map_run['mapRunArn']])
+        if map_run['maxConcurrency'] != max_concurrency:
+            STEPFUNCTIONS_CLIENT.update_map_run(mapRunArn=map_run['mapRunArn'], maxConcurrency=max_concurrency)
+            LOGGER.info(f"map run {map_run['mapRunArn']} max concurrency set to {max_concurrency}")
+    return sum(shares.values())
+
+
+def publish_metrics(depths, started, wait_times, running):
+    """
+    Publishes the queue depth and started calls of every lane and of the batch imports, the queue wait time of
+    every lane and the running executions to CloudWatch
+    """
+    metric_data = [{'MetricName': 'RunningExecutions', 'Value': sum(running.values()), 'Unit': 'Count'}]
+    for lane in depths:
+        dimensions = [{'Name': 'Lane', 'Value': lane}]
+        metric_data.append({'MetricName': 'QueueDepth', 'Dimensions': dimensions,
+                            'Value': depths[lane], 'Unit': 'Count'})
+        metric_data.append({'MetricName': 'StartedExecutions', 'Dimensions': dimensions,
+                            'Value': started[lane], 'Unit': 'Count'})
+        if wait_times.get(lane):
+            metric_data.append({'MetricName': 'QueueWaitTime', 'Dimensions': dimensions,
+                                'Values': wait_times[lane][:150], 'Unit': 'Seconds'})
+    CLOUDWATCH_CLIENT.put_metric_data(Namespace=METRIC_NAMESPACE, MetricData=metric_data)
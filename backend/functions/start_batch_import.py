@@ -0,0 +1,181 @@
+import boto3
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+from common_lib import id_generator
+
+logging.basicConfig()
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+STEPFUNCTIONS_CLIENT = boto3.client('stepfunctions')
+S3_CLIENT = boto3.client('s3')
+BATCH_STEP_FUNCTION_ARN = os.environ['BATCH_STEP_FUNCTION_ARN']
+# Bucket that holds the item list, the per-item results and the report of every batch
+BUCKET = os.environ['BUCKET_NAME']
+
+EXTENSION_TO_CONTENT_TYPE = {
+    ".mp3": "audio/mpeg",
+    ".wav": "audio/wav",
+    ".flac": "audio/flac",
+    ".mp4": "audio/mp4a-latm",
+    ".m4a": "audio/mp4a-latm"}
+
+# Metadata that can be given for every recording of the batch, and overridden per recording by the manifest
+METADATA_FIELDS = ("jurisdiction", "description", "procedure")
+
+
+class InvalidManifestError(ValueError):
+    """
+    Error raised on a manifest that cannot be turned into a list of recordings
+    """
+    pass
+
+
+def lambda_handler(event, context):
+    """
+    Entry point for importing an archive of recordings with a single step functions execution instead of one
+    DynamoDB row and one execution per recording. The recordings are either every audio file under an S3 prefix
+    or the rows of a CSV/JSON manifest, and they are transcribed, processed and indexed by the batch state machine
+
+    Expected input, either
+        {"bucketName": ..., "prefix": ..., "jurisdiction": ..., "description": ..., "procedure": ...}
+    or
+        {"manifestBucket": ..., "manifestKey": ..., "jurisdiction": ..., "description": ..., "procedure": ...}
+    A manifest is a CSV file with a header row, or a JSON list of objects, with a `bucketKey` for every
+    recording and optionally `bucketName`, `fileType`, `fileName`, `dynamoId` and the metadata fields
+    The recordings are kept after they are indexed unless the input sets "deleteSourceAudio": true
+
+    :param event: The location of the recordings and the default metadata of the batch
+    :return: The batch id, the started execution and the number of recordings in the batch
+    """
+    defaults = {field: event.get(field, "") for field in METADATA_FIELDS}
+    if 'manifestKey' in event:
+        rows = read_manifest(event['manifestBucket'], event['manifestKey'])
+        default_bucket = event.get('bucketName', event['manifestBucket'])
+    elif 'prefix' in event:
+        rows = list_prefix(event['bucketName'], event['prefix'])
+        default_bucket = event['bucketName']
+    else:
+        raise InvalidManifestError("Either a manifestKey or a bucketName and prefix is required")
+
+    items = [build_item(row, default_bucket, defaults) for row in rows]
+    if not items:
+        raise InvalidManifestError("The batch does not contain any supported recordings")
+    check_unique_ids(items)
+
+    batch_id = id_generator(size=12)
+    items_key = f"batches/{batch_id}/items.json"
+    S3_CLIENT.put_object(Body=json.dumps(items), Bucket=BUCKET, Key=items_key)
+    LOGGER.info(f"batch {batch_id} has {len(items)} recordings, written to s3://{BUCKET}/{items_key}")
+
+    response = STEPFUNCTIONS_CLIENT.start_execution(
+        stateMachineArn=BATCH_STEP_FUNCTION_ARN,
+        name=f"batch-{batch_id}",
+        input=json.dumps({
+            "batchId": batch_id,
+            "itemsBucket": BUCKET,
+            "itemsKey": items_key,
+            "resultsPrefix": f"batches/{batch_id}/results",
+            "deleteSourceAudio": event.get('deleteSourceAudio') is True
+        })
+    )
+
+    return {
+        "batchId": batch_id,
+        "executionArn": response['executionArn'],
+        "itemCount": len(items)
+    }
+
+
+def read_manifest(bucket, key):
+    """
+    Reads a CSV or JSON manifest from S3
+
+    :param bucket: Bucket of the manifest
+    :param key: Key of the manifest, a .json key is read as JSON and anything else as CSV
+    :return: List of dicts, one per recording
+    """
+    response = S3_CLIENT.get_object(Bucket=bucket, Key=key)
+    content = response['Body'].read().decode('utf-8-sig')
+    if key.lower().endswith('.json'):
+        rows = json.loads(content)
+        if not isinstance(rows, list):
+            raise InvalidManifestError(f"s3://{bucket}/{key} must contain a JSON list")
+        return rows
+    return list(csv.DictReader(io.StringIO(content)))
+
+
+def list_prefix(bucket, prefix):
+    """
+    Lists every audio file of a supported type under the S3 prefix
+
+    :param bucket: Bucket of the recordings
+    :param prefix: Key prefix of the recordings
+    :return: List of dicts with the `bucketKey` of every recording
+    """
+    rows = []
+    paginator = S3_CLIENT.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for s3_object in page.get('Contents', []):
+            if os.path.splitext(s3_object['Key'])[1].lower() in EXTENSION_TO_CONTENT_TYPE:
+                rows.append({"bucketKey": s3_object['Key']})
+    return rows
+
+
+def build_item(row, default_bucket, defaults):
+    """
+    Turns a manifest row into the same input that `start_trigger.py` gives a single execution
+
+    :param row: Dict with at least the `bucketKey` of the recording
+    :param default_bucket: Bucket used when the row does not name one
+    :param defaults: Metadata used when the row does not give it
+    :return: The input for the per-recording steps of the batch state machine
+    """
+    key = row.get('bucketKey')
+    if not key:
+        raise InvalidManifestError(f"Manifest row without a bucketKey: {row}")
+
+    file_type = row.get('fileType') or EXTENSION_TO_CONTENT_TYPE.get(os.path.splitext(key)[1].lower())
+    if file_type is None:
+        raise InvalidManifestError(f"Cannot tell the audio type of {key}, add a fileType to the manifest")
+
+    item = {
+        "dynamoId": row.get('dynamoId') or recording_id(row.get('bucketName') or default_bucket, key),
+        "bucketName": row.get('bucketName') or default_bucket,
+        "bucketKey": key,
+        "fileType": file_type,
+        "fileName": row.get('fileName') or os.path.basename(key),
+        # Batch transcripts are indexed together with bulk requests by `Index Batch`, not one by one
+        "progressiveIndexing": False
+    }
+    for field in METADATA_FIELDS:
+        item[field] = row.get(field) or defaults[field]
+    return item
+
+
+def recording_id(bucket, key):
+    """
+    Derives the id of a recording from its location. The id is the document id in Elasticsearch, so importing
+    the same recording again, for example when re-running a partially failed batch, overwrites its document
+    instead of adding a duplicate
+    """
+    return hashlib.sha256(f"{bucket}/{key}".encode('utf-8')).hexdigest()[:20].upper()
+
+
+def check_unique_ids(items):
+    """
+    Rejects a batch in which two recordings have the same id, as they would overwrite each other's document and
+    report entry. This happens when a manifest repeats a dynamoId or lists the same recording twice
+    """
+    seen = set()
+    duplicates = set()
+    for item in items:
+        if item['dynamoId'] in seen:
+            duplicates.add(item['dynamoId'])
+        seen.add(item['dynamoId'])
+    if duplicates:
+        raise InvalidManifestError(f"Recordings with duplicate ids: {', '.join(sorted(duplicates))}")
@@ -1,19 +1,29 @@
 import boto3
 import os
 import json
-from common_lib import id_generator
 
-STEPFUNCTIONS_CLIENT = boto3.client('stepfunctions')
-STEPFUNCTIONS_ARN = os.environ['STEP_FUNCTION_ARN']
+SQS_CLIENT = boto3.client('sqs')
+LAMBDA_CLIENT = boto3.client('lambda')
+SCHEDULER_FUNCTION_NAME = os.environ['SCHEDULER_FUNCTION_NAME']
+
+# Calls wait in the queue of their priority lane until the scheduler has capacity to start them
+LANE_QUEUE_URLS = {
+    "interactive": os.environ['INTERACTIVE_QUEUE_URL'],
+    "bulk": os.environ['BULK_QUEUE_URL']
+}
+# Uploads from the frontend do not set a priority and are interactive
+DEFAULT_PRIORITY = "interactive"
 
 
 def lambda_handler(event, context):
     """
     The first lambda function that runs, triggered by a DynamoDB Transcripts table event
-    Starts the state machine and gives it the key for audio file stored in S3 for audio transcription
+    Queues the key for audio file stored in S3 for audio transcription in the lane of the record's `priority`
+    and lets the scheduler start the state machine
     Does not return any value for another lambda function
     """
 
+    queued = False
     for record in event.get('Records'):
         if record.get('eventName') in ('INSERT', 'MODIFY'):
 
@@ -26,6 +36,10 @@ def lambda_handler(event, context):
             Description = record['dynamodb']['NewImage']['description']['S']
             FileType = record['dynamodb']['NewImage']['fileType']['S']
             FileName = record['dynamodb']['NewImage']['fileName']['S']
+            Priority = record['dynamodb']['NewImage'].get('priority', {}).get('S', DEFAULT_PRIORITY)
+            if Priority not in LANE_QUEUE_URLS:
+                print(f"Unknown priority {Priority}, using {DEFAULT_PRIORITY}")
+                Priority = DEFAULT_PRIORITY
 
             request_params = {
                 "dynamoId": Id,
@@ -38,10 +52,14 @@ def lambda_handler(event, context):
                 "fileName": FileName
             }
 
-            response = STEPFUNCTIONS_CLIENT.start_execution(
-                stateMachineArn=STEPFUNCTIONS_ARN,
-                name=id_generator(),
-                input=json.dumps(request_params, indent=4, sort_keys=True, default=str)
+            response = SQS_CLIENT.send_message(
+                QueueUrl=LANE_QUEUE_URLS[Priority],
+                MessageBody=json.dumps(request_params, indent=4, sort_keys=True, default=str)
             )
+            queued = True
         else:
             print("Should only expect insert/modify DynamoDB operations")
+
+    # Start the queued calls right away if there is capacity instead of waiting for the scheduled run
+    if queued:
+        LAMBDA_CLIENT.invoke(FunctionName=SCHEDULER_FUNCTION_NAME, InvocationType='Event')
@@ -0,0 +1,190 @@
+"""
+Contains helper functions only, not a lambda function file
+Stitches the results of the Transcribe jobs of a split recording back into a single Transcribe shaped result
+"""
+
+
+def shift_time(time_stamp, offset):
+    """
+    Shifts a Transcribe time stamp string by offset seconds, keeping the string format of Transcribe
+    """
+    return f"{float(time_stamp) + offset:.3f}"
+
+
+def reconcile_speakers(previous_segments, current_segments, window_start, window_end, next_free_label):
+    """
+    Maps the local speaker labels of a segment onto the speaker labels already used in the stitched result.
+    Both Transcribe jobs heard the audio between window_start and window_end, so the labels that talk at the
+    same time in that overlap are the same speaker. Labels are matched greedily by the amount of time they
+    overlap. A speaker that is silent during the overlap cannot be matched that way, so the labels left over on
+    both sides are paired in the order they speak, the previous job's labels starting with the last to speak.
+    Only labels left over after that are given a new label
+    Helper function for ``stitch_results()``
+
+    :param previous_segments: Speaker segments of the previous job with global times and stitched labels
+    :param current_segments: Speaker segments of the current job with global times and local labels
+    :param window_start: Start of the audio shared by both jobs, in seconds
+    :param window_end: End of the audio shared by both jobs, in seconds
+    :param next_free_label: Number of the next speaker label that has not been used in the stitched result
+    :return: A dict mapping local labels to stitched labels, and the next unused label number
+    """
+    agreement = {}
+    for previous in previous_segments:
+        for current in current_segments:
+            start = max(previous['start_time'], current['start_time'], window_start)
+            end = min(previous['end_time'], current['end_time'], window_end)
+            if end > start:
+                pair = (current['speaker_label'], previous['speaker_label'])
+                agreement[pair] = agreement.get(pair, 0.0) + end - start
+
+    mapping = {}
+    used = set()
+    for (local, stitched), _ in sorted(agreement.items(), key=lambda pair_time: -pair_time[1]):
+        if local not in mapping and stitched not in used:
+            mapping[local] = stitched
+            used.add(stitched)
+
+    # Every job diarizes the same speakers, so a speaker that was silent in the overlap is still one of the
+    # previous job's speakers that did not get matched
+    unmatched_stitched = []
+    for segment in sorted(previous_segments, key=lambda segment: -segment['end_time']):
+        stitched = segment['speaker_label']
+        if stitched not in used and stitched not in unmatched_stitched:
+            unmatched_stitched.append(stitched)
+
+    for segment in current_segments:
+        local = segment['speaker_label']
+        if local in mapping:
+            continue
+        if unmatched_stitched:
+            mapping[local] = unmatched_stitched.pop(0)
+        else:
+            mapping[local] = f"spk_{next_free_label}"
+            next_free_label += 1
+    return mapping, next_free_label
+
+
+def keep_items(items, offset, keep_from, keep_until, mapping):
+    """
+    Shifts the items of one job to global time and keeps the ones that start inside [keep_from, keep_until).
+    Punctuation items have no time stamps and follow the pronunciation item before them
+    Helper function for ``stitch_results()``
+
+    :param items: The 'items' list of one Transcribe result
+    :param offset: Start of the job's audio in the full recording, in seconds
+    :param keep_from: Global time before which items belong to the previous job
+    :param keep_until: Global time from which items belong to the next job
+    :param mapping: Dict mapping the job's local speaker labels to stitched labels
+    :return: List of kept items with global time stamps
+    """
+    kept = []
+    keeping = False
+    for item in items:
+        if 'start_time' in item:
+            start = float(item['start_time']) + offset
+            keeping = keep_from <= start < keep_until
+            if keeping:
+                item = dict(item,
+                            start_time=shift_time(item['start_time'], offset),
+                            end_time=shift_time(item['end_time'], offset))
+        if keeping:
+            if item.get('speaker_label') in mapping:
+                item = dict(item, speaker_label=mapping[item['speaker_label']])
+            kept.append(item)
+    return kept
+
+
+def stitch_results(segment_results):
+    """
+    Merges the Transcribe results of the segments of a split recording into one result with the same shape as
+    a single Transcribe job, so that it can be processed by ``chunk_up_transcript()``.
+    Time stamps are shifted by the start of each segment, items that were transcribed twice in the overlap are
+    only kept once, and speaker labels are made consistent across segments. Channel labels name the same
+    channel in every segment and are kept as they are
+
+    :param segment_results: List of dicts, in recording order, with the 'results' of each job, the 'start' and
+                            'end' of the segment in the recording and the 'cut' after which the next segment
+                            takes over
+    :return: A Transcribe results dict for the whole recording
+    """
+    items = []
+    stitched_segments = []
+    stitched_channels = {}
+    previous_segments = []
+    previous_end = 0.0
+    keep_from = 0.0
+    next_free_label = 0
+
+    for segment in segment_results:
+        results = segment['results']
+        offset = segment['start']
+        keep_until = segment['cut'] if segment is not segment_results[-1] else float('inf')
+
+        current_segments = []
+        for label in results.get('speaker_labels', {}).get('segments', []):
+            current_segments.append(dict(label,
+                                         start_time=float(label['start_time']) + offset,
+                                         end_time=float(label['end_time']) + offset))
+
+        mapping, next_free_label = reconcile_speakers(previous_segments, current_segments,
+                                                      offset, previous_end, next_free_label)
+
+        for label in current_segments:
+            start = max(label['start_time'], keep_from)
+            end = min(label['end_time'], keep_until)
+            if end <= start:
+                continue
+            speaker = mapping[label['speaker_label']]
+            stitched_segments.append({
+                'start_time': f"{start:.3f}",
+                'end_time': f"{end:.3f}",
+                'speaker_label': speaker,
+                'items': [dict(word,
+                               start_time=shift_time(word['start_time'], offset),
+                               end_time=shift_time(word['end_time'], offset),
+                               speaker_label=speaker)
+                          for word in label.get('items', [])
+                          if keep_from <= float(word['start_time']) + offset < keep_until]
+            })
+
+        items.extend(keep_items(results['items'], offset, keep_from, keep_until, mapping))
+        for channel in results.get('channel_labels', {}).get('channels', []):
+            stitched_channels.setdefault(channel['channel_label'], []).extend(
+                keep_items(channel['items'], offset, keep_from, keep_until, {}))
+
+        previous_segments = [dict(label, speaker_label=mapping[label['speaker_label']])
+                             for label in current_segments]
+        previous_end = segment['end']
+        keep_from = keep_until
+
+    stitched = {
+        'transcripts': [{'transcript': join_items(items)}],
+        'items': items
+    }
+    if stitched_segments:
+        stitched['speaker_labels'] = {
+            'speakers': len({label['speaker_label'] for label in stitched_segments}),
+            'segments': stitched_segments
+        }
+    if stitched_channels:
+        stitched['channel_labels'] = {
+            'channels': [{'channel_label': label, 'items': channel_items}
+                         for label, channel_items in sorted(stitched_channels.items())],
+            'number_of_channels': len(stitched_channels)
+        }
+    return stitched
+
+
+def join_items(items):
+    """
+    Rebuilds the plain transcript text from Transcribe items
+    Helper function for ``stitch_results()``
+    """
+    text = ""
+    for item in items:
+        content = item['alternatives'][0]['content']
+        if item['type'] == 'punctuation' or not text:
+            text = f"{text}{content}"
+        else:
+            text = f"{text} {content}"
+    return text
@@ -1,11 +1,12 @@
 from __future__ import print_function
 
 import boto3
-import certifi
 import json
 import os
-from aws_requests_auth.aws_auth import AWSRequestsAuth
-from elasticsearch import Elasticsearch, RequestsHttpConnection
+from elasticsearch import NotFoundError
+from elasticsearch.helpers import streaming_bulk
+from concurrent.futures import ThreadPoolExecutor
+from es_lib import ES_CLIENT, ES_INDEX, build_document, fail_pending_enrichment, is_progressive
 import logging
 import time
 
@@ -17,41 +18,20 @@ if os.getenv('LOG_LEVEL') == 'DEBUG':
 else:
     LOGGER.setLevel(logging.INFO)
 
-# Parameters
-REGION = os.getenv('AWS_REGION', default='us-east-1')
-
-# Pull environment data for the ES domain
-ES_ENDPOINT = os.environ['ES_DOMAIN']
 # If debug mode is TRUE, then S3 files are not deleted
 IS_DEBUG_MODE = os.environ['DEBUG_MODE']
 
-# get the Elasticsearch index name from the environment variables
-ES_INDEX = os.getenv('ES_INDEX', default='transcripts')
+# Number of documents sent in a single bulk request when indexing a batch import
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', default='100'))
+# Number of processed transcripts read from S3 at the same time when indexing a batch import
+S3_READ_THREADS = 16
+# Recordings indexed between two checkpoints of a batch import
+CHECKPOINT_ITEMS = int(os.getenv('CHECKPOINT_ITEMS', default='1000'))
+# A batch import invocation with less time left than this does not start a new chunk but lets the state machine
+# invoke it again
+CHECKPOINT_MARGIN_SECONDS = 120
 
 S3_CLIENT = boto3.client('s3')
-# Create the auth token for the sigv4 signature
-SESSION = boto3.session.Session()
-CREDENTIALS = SESSION.get_credentials().get_frozen_credentials()
-AWS_AUTH = AWSRequestsAuth(
-    aws_access_key=CREDENTIALS.access_key,
-    aws_secret_access_key=CREDENTIALS.secret_key,
-    aws_token=CREDENTIALS.token,
-    aws_host=ES_ENDPOINT,
-    aws_region=REGION,
-    aws_service='es'
-)
-
-# Connect to the elasticsearch cluster using aws authentication. The lambda function
-# must have access in an IAM policy to the ES cluster.
-ES_CLIENT = Elasticsearch(
-    hosts=[{'host': ES_ENDPOINT, 'port': 443}],
-    http_auth=AWS_AUTH,
-    use_ssl=True,
-    verify_certs=True,
-    ca_certs=certifi.where(),
-    timeout=120,
-    connection_class=RequestsHttpConnection
-)
 
 
 # Entry point into the lambda function
@@ -60,9 +40,11 @@ def lambda_handler(event, context):
     Lambda handler executed after transcription is processed. This function takes the the processed transcription
     and indexes it into the ElasticSearch.
     The transcript is deleted afterwards in non-debug mode (stored as a environment variable)
+    In progressive indexing mode the call was already indexed by `process_transcription_full_text.py`
     """
     call_transcript_s3_location = event["processTranscriptionResult"]
-    index_transcript(event, call_transcript_s3_location)
+    if not call_transcript_s3_location.get('indexed'):
+        index_transcript(event, call_transcript_s3_location)
 
     if IS_DEBUG_MODE != 'TRUE':
         # Deletes the audio files in the amplify frontend storage bucket
@@ -72,25 +54,7 @@ def lambda_handler(event, context):
 
 
 def index_transcript(event, call_transcript_s3_location):
-    # Retrieves the transcribed text file stored in S3
-    response = S3_CLIENT.get_object(Bucket=call_transcript_s3_location['bucket'],
-                                    Key=call_transcript_s3_location['key'])
-    file_content = response['Body'].read().decode('utf-8')
-    full_call_transcript = json.loads(file_content)
-
-    s3_location = "s3://" + event['bucketName'] + "/" + event['bucketKey']
-
-    # Metadata of the processed transcript that is indexed in elasticsearch
-    doc = {
-        'audio_type': event['fileType'],
-        'name': event['fileName'],
-        'jurisdiction': event['jurisdiction'],
-        'description': event['description'],
-        'procedure': event['procedure'],
-        'audio_s3_location': s3_location,
-        'transcript':  full_call_transcript['transcript'],
-        'key_phrases': full_call_transcript['key_phrases']
-    }
+    doc = build_document(event, read_transcript(call_transcript_s3_location))
 
     LOGGER.info("request")
     LOGGER.debug(json.dumps(doc))
@@ -101,3 +65,213 @@ def index_transcript(event, call_transcript_s3_location):
     LOGGER.info("response")
     LOGGER.info(json.dumps(res, indent=4))
     LOGGER.info('REQUEST_TIME es_client.index {:10.4f}'.format(time.time() - start))
+
+
+def enrichment_failed_lambda_handler(event, context):
+    """
+    Lambda handler executed when `Process Transcription` fails for good, for example when it times out while
+    Amazon Comprehend extracts the key phrases. In progressive indexing mode the call is already indexed with
+    a PENDING enrichment status, which is set to FAILED so clients stop waiting for the key phrases.
+    Calls that were not indexed progressively, were never indexed, or whose enrichment is not pending, for example
+    the complete document of an earlier run, are left alone
+
+    :param event: The state machine input with the call's dynamoId and the error in event['error']
+    :return: Whether a document was marked as failed
+    """
+    LOGGER.error(f"processing of {event['dynamoId']} failed: {json.dumps(event.get('error'))}")
+    if not is_progressive(event):
+        LOGGER.info(f"{event['dynamoId']} is not indexed progressively, nothing to mark as failed")
+        return {"marked": False}
+    try:
+        marked = fail_pending_enrichment(event['dynamoId'])
+    except NotFoundError:
+        LOGGER.info(f"{event['dynamoId']} was not indexed, nothing to mark as failed")
+        return {"marked": False}
+    if not marked:
+        LOGGER.info(f"the enrichment of {event['dynamoId']} is not pending, left as it is")
+    return {"marked": marked}
+
+
+def read_transcript(call_transcript_s3_location):
+    """
+    Retrieves the processed transcript stored in S3 by `process_transcription_full_text.py`
+    """
+    response = S3_CLIENT.get_object(Bucket=call_transcript_s3_location['bucket'],
+                                    Key=call_transcript_s3_location['key'])
+    file_content = response['Body'].read().decode('utf-8')
+    return json.loads(file_content)
+
+
+def batch_lambda_handler(event, context):
+    """
+    Lambda handler executed at the end of a batch import, after the distributed map has transcribed and processed
+    every recording. It indexes all the processed transcripts with bulk requests and writes a report with the
+    success or failure of every recording next to the map results in S3.
+    The progress is checkpointed to S3 after every CHECKPOINT_ITEMS recordings, so a retried or repeated
+    invocation continues where the previous one stopped. When the invocation runs low on time it returns with
+    'complete' set to False and the state machine invokes it again
+
+    :param event: The batch state machine input, with the map results location in event['mapResult']
+    :return: Whether the batch is completely indexed, and then the location of the report and the number of
+             succeeded and failed recordings
+    """
+    writer_details = event['mapResult']['ResultWriterDetails']
+    bucket = writer_details['Bucket']
+    checkpoint_key = f"batches/{event['batchId']}/index-checkpoint.json"
+    item_results = read_map_results(bucket, writer_details['Key'])
+
+    processed = [item for item, status, _ in item_results if status == 'SUCCEEDED']
+    # Recordings processed in progressive indexing mode are already indexed
+    to_index = [item for item in processed if not item['processTranscriptionResult'].get('indexed')]
+
+    checkpoint = read_checkpoint(bucket, checkpoint_key)
+    if checkpoint:
+        report, position = checkpoint['report'], checkpoint['position']
+        LOGGER.info(f"batch {event['batchId']}: resuming at {position} of {len(to_index)} recordings")
+    else:
+        report, position = build_report(item_results), 0
+
+    while position < len(to_index):
+        if context.get_remaining_time_in_millis() < CHECKPOINT_MARGIN_SECONDS * 1000:
+            LOGGER.info(f"batch {event['batchId']}: {position} of {len(to_index)} recordings indexed, continuing")
+            return {"complete": False, "indexed": position, "total": len(to_index)}
+        chunk = to_index[position:position + CHECKPOINT_ITEMS]
+        start = time.time()
+        index_chunk(chunk, report)
+        LOGGER.info('REQUEST_TIME streaming_bulk {:10.4f}'.format(time.time() - start))
+        position += len(chunk)
+        S3_CLIENT.put_object(Body=json.dumps({"position": position, "report": report}),
+                             Bucket=bucket, Key=checkpoint_key)
+
+    # Archived recordings are only deleted when the batch import explicitly asked for it
+    if event.get('deleteSourceAudio') is True:
+        for item in processed:
+            if report[item['dynamoId']]['status'] == 'SUCCEEDED':
+                S3_CLIENT.delete_object(Bucket=item['bucketName'], Key=item['bucketKey'])
+
+    items = list(report.values())
+    succeeded = sum(1 for item in items if item['status'] == 'SUCCEEDED')
+    report_key = f"batches/{event['batchId']}/report.json"
+    S3_CLIENT.put_object(Body=json.dumps({"batchId": event['batchId'], "succeeded": succeeded,
+                                          "failed": len(items) - succeeded, "items": items}, indent=2),
+                         Bucket=bucket, Key=report_key)
+    S3_CLIENT.delete_object(Bucket=bucket, Key=checkpoint_key)
+    LOGGER.info(f"batch {event['batchId']}: {succeeded} of {len(items)} recordings indexed")
+
+    return {
+        "complete": True,
+        "reportBucket": bucket,
+        "reportKey": report_key,
+        "succeeded": succeeded,
+        "failed": len(items) - succeeded
+    }
+
+
+def build_report(item_results):
+    """
+    Builds the report entry of every recording of the batch from the map results
+    Helper function for ``batch_lambda_handler()``
+
+    :param item_results: List of (item, status, error) tuples as returned by ``read_map_results()``
+    :return: Dict of report entries by dynamoId
+    """
+    report = {}
+    for item, status, error in item_results:
+        if item['dynamoId'] in report:
+            LOGGER.warning(f"{item['dynamoId']} is in the batch more than once, only its last result is reported")
+        report[item['dynamoId']] = {
+            "dynamoId": item['dynamoId'],
+            "bucketKey": item['bucketKey'],
+            "fileName": item['fileName'],
+            "status": status,
+            "error": error
+        }
+    return report
+
+
+def read_checkpoint(bucket, key):
+    """
+    Reads the indexing progress of a batch import written by an earlier invocation of ``batch_lambda_handler()``
+
+    :return: Dict with the 'position' in the recordings to index and the 'report' so far, None on the first
+             invocation
+    """
+    try:
+        response = S3_CLIENT.get_object(Bucket=bucket, Key=key)
+    except S3_CLIENT.exceptions.NoSuchKey:
+        return None
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+
+def index_chunk(items, report):
+    """
+    Indexes the processed transcripts of items with bulk requests and marks the ones that could not be indexed
+    as failed in the report. Failed bulk requests are reported per recording instead of raised, with the error
+    and status only, the failed document and exception are left out of the log
+    Helper function for ``batch_lambda_handler()``
+    """
+    for ok, info in streaming_bulk(ES_CLIENT, bulk_actions(items, report), chunk_size=BULK_CHUNK_SIZE,
+                                   raise_on_error=False, raise_on_exception=False):
+        if ok:
+            continue
+        result = info['index']
+        error = result.get('error')
+        error = error if isinstance(error, str) else json.dumps(error)
+        LOGGER.error(f"could not index {result['_id']}: status {result.get('status')}, error {error}")
+        report[result['_id']].update(status='FAILED', error=error)
+
+
+def read_map_results(bucket, manifest_key):
+    """
+    Reads the per-recording results that the distributed map wrote to S3.
+    Every recording ends with an `itemStatus` of SUCCEEDED or FAILED, child executions that did not finish
+    at all are reported as FAILED with their error
+
+    :param bucket: Bucket of the map results
+    :param manifest_key: Key of the manifest.json written by the map
+    :return: List of (item, status, error) tuples
+    """
+    response = S3_CLIENT.get_object(Bucket=bucket, Key=manifest_key)
+    manifest = json.loads(response['Body'].read().decode('utf-8'))
+
+    item_results = []
+    for result_status, result_files in manifest['ResultFiles'].items():
+        for result_file in result_files:
+            response = S3_CLIENT.get_object(Bucket=bucket, Key=result_file['Key'])
+            for execution in json.loads(response['Body'].read().decode('utf-8')):
+                if result_status == 'SUCCEEDED':
+                    item = json.loads(execution['Output'])
+                    error = item.get('error')
+                    item_results.append((item, item['itemStatus'], json.dumps(error) if error else None))
+                else:
+                    item = json.loads(execution['Input'])
+                    item_results.append((item, 'FAILED', execution.get('Error') or result_status))
+    return item_results
+
+
+def bulk_actions(processed, report):
+    """
+    Generates the bulk index actions of the processed recordings. The transcripts are read from S3 a few at
+    a time in parallel, so the whole batch never has to be held in memory. Recordings whose transcript cannot
+    be read are marked as failed in the report
+    Helper function for ``batch_lambda_handler()``
+    """
+    def try_read_transcript(item):
+        try:
+            return read_transcript(item['processTranscriptionResult'])
+        except Exception as e:
+            LOGGER.error(f"could not read the transcript of {item['dynamoId']}: {e}")
+            report[item['dynamoId']].update(status='FAILED', error=str(e))
+            return None
+
+    with ThreadPoolExecutor(max_workers=S3_READ_THREADS) as executor:
+        for start in range(0, len(processed), BULK_CHUNK_SIZE):
+            chunk = processed[start:start + BULK_CHUNK_SIZE]
+            for item, full_call_transcript in zip(chunk, executor.map(try_read_transcript, chunk)):
+                if full_call_transcript is None:
+                    continue
+                yield {
+                    '_index': ES_INDEX,
+                    '_id': item['dynamoId'],
+                    '_source': build_document(item, full_call_transcript)
+                }
@@ -0,0 +1,17 @@
+import os
+import sys
+
+# The lambda functions import each other as top level modules, as they do when deployed
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'functions'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# The lambda functions read their configuration and create their AWS clients when they are imported. The clients
+# are replaced by fakes in the tests, and never reach AWS
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('BUCKET_NAME', 'transcripts-bucket')
+os.environ.setdefault('ES_DOMAIN', 'localhost')
+os.environ.setdefault('STEP_FUNCTION_ARN', 'arn:aws:states:us-east-1:123456789012:stateMachine:transcribe')
+os.environ.setdefault('INTERACTIVE_QUEUE_URL', 'https://sqs.us-east-1.amazonaws.com/123456789012/interactive')
+os.environ.setdefault('BULK_QUEUE_URL', 'https://sqs.us-east-1.amazonaws.com/123456789012/bulk')
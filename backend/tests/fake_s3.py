@@ -0,0 +1,50 @@
+import io
+from types import SimpleNamespace
+
+"""
+Test helper only, not deployed with the lambda functions
+A local stand-in for the boto3 S3 client that keeps objects in memory and answers the S3 calls the lambda
+functions make, including ranged GETs:
+
+    s3 = FakeS3Client()
+    s3.put_object(Body=recording, Bucket='calls', Key='call.wav')
+    monkeypatch.setattr(call_transcribe, 'S3_CLIENT', s3)
+"""
+
+
+class FakeNoSuchKeyError(Exception):
+    """
+    Error raised by the fake client for a missing object, mirrors NoSuchKey
+    """
+    pass
+
+
+class FakeS3Client:
+    """
+    Answers get_object, put_object, upload_file and delete_object like the boto3 S3 client does
+    """
+    exceptions = SimpleNamespace(NoSuchKey=FakeNoSuchKeyError)
+
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, Bucket, Key, Range=None):
+        if (Bucket, Key) not in self.objects:
+            raise FakeNoSuchKeyError(f"s3://{Bucket}/{Key} does not exist")
+        body = self.objects[(Bucket, Key)]
+        if Range is not None:
+            first, last = Range[len('bytes='):].split('-')
+            body = body[int(first):int(last) + 1]
+        return {'Body': io.BytesIO(body), 'ContentLength': len(body)}
+
+    def put_object(self, Body, Bucket, Key, **kwargs):
+        self.objects[(Bucket, Key)] = Body.encode('utf-8') if isinstance(Body, str) else Body
+        return {}
+
+    def upload_file(self, Filename, Bucket, Key):
+        with open(Filename, 'rb') as upload:
+            self.objects[(Bucket, Key)] = upload.read()
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+        return {}
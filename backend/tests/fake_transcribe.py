@@ -0,0 +1,151 @@
+import json
+import os
+from types import SimpleNamespace
+
+"""
+Test helper only, not deployed with the lambda functions
+A local stand-in for the boto3 Transcribe client. Jobs are answered by slicing a full length Transcribe result,
+so the split and stitch of long recordings can be exercised without calling AWS:
+
+    client = FakeTranscribeClient(json.load(open('full_result.json'))['results'], '/tmp/fake-transcribe')
+    client.register_media(segment_url, start, end)
+    monkeypatch.setattr(call_transcribe, 'TRANSCRIBE_CLIENT', client)
+"""
+
+
+class FakeTranscribeError(Exception):
+    """
+    Error raised by the fake client, mirrors the botocore ClientError family
+    """
+    pass
+
+
+class FakeConflictError(FakeTranscribeError):
+    """
+    Error raised by the fake client when a job name is already used, mirrors ConflictException
+    """
+    pass
+
+
+class FakeTranscribeClient:
+    """
+    Answers start_transcription_job and get_transcription_job like the boto3 Transcribe client does
+    """
+    exceptions = SimpleNamespace(
+        ConflictException=FakeConflictError,
+        BadRequestException=FakeTranscribeError,
+        LimitExceededException=FakeTranscribeError,
+        ClientError=FakeTranscribeError
+    )
+
+    def __init__(self, reference_results, output_dir, polls_until_complete=1, swap_speakers=True):
+        """
+        :param reference_results: The 'results' of a Transcribe job for the whole recording
+        :param output_dir: Directory the results of the fake jobs are written into
+        :param polls_until_complete: Number of get_transcription_job calls that report IN_PROGRESS
+        :param swap_speakers: Swaps spk_0 and spk_1 on every other segment, like diarization of
+                              separate jobs would, so the speaker reconciliation of the stitcher is exercised
+        """
+        self.reference_results = reference_results
+        self.output_dir = output_dir
+        self.polls_until_complete = polls_until_complete
+        self.swap_speakers = swap_speakers
+        self.media = {}
+        self.jobs = {}
+        os.makedirs(output_dir, exist_ok=True)
+
+    def register_media(self, media_uri, start, end):
+        """
+        Registers the part of the reference recording, in seconds, that the media at media_uri contains
+        """
+        self.media[media_uri] = (start, end)
+
+    def start_transcription_job(self, TranscriptionJobName, Media, **kwargs):
+        if TranscriptionJobName in self.jobs:
+            raise FakeConflictError(f"{TranscriptionJobName} already exists")
+        media_uri = Media['MediaFileUri']
+        start, end = self.media.get(media_uri, (0.0, float('inf')))
+        relabel = {}
+        if self.swap_speakers and len(self.jobs) % 2 == 1:
+            relabel = {'spk_0': 'spk_1', 'spk_1': 'spk_0'}
+        results = slice_results(self.reference_results, start, end, relabel)
+
+        path = os.path.join(self.output_dir, f"{TranscriptionJobName}.json")
+        with open(path, 'w') as output:
+            json.dump({'jobName': TranscriptionJobName, 'results': results, 'status': 'COMPLETED'}, output)
+
+        self.jobs[TranscriptionJobName] = {'uri': f"file://{os.path.abspath(path)}", 'polls': 0}
+        return {'TranscriptionJob': {'TranscriptionJobName': TranscriptionJobName,
+                                     'TranscriptionJobStatus': 'IN_PROGRESS',
+                                     'Media': Media}}
+
+    def fail_job(self, job_name):
+        """
+        Makes the job report FAILED from now on
+        """
+        self.jobs[job_name]['failed'] = True
+
+    def get_transcription_job(self, TranscriptionJobName):
+        job = self.jobs[TranscriptionJobName]
+        job['polls'] += 1
+        response = {'TranscriptionJobName': TranscriptionJobName}
+        if job.get('failed'):
+            response['TranscriptionJobStatus'] = 'FAILED'
+            response['FailureReason'] = 'failed by the test'
+        elif job['polls'] <= self.polls_until_complete:
+            response['TranscriptionJobStatus'] = 'IN_PROGRESS'
+        else:
+            response['TranscriptionJobStatus'] = 'COMPLETED'
+            response['Transcript'] = {'RedactedTranscriptFileUri': job['uri']}
+        return {'TranscriptionJob': response}
+
+
+def slice_results(results, start, end, relabel):
+    """
+    Cuts the part between start and end seconds out of a Transcribe result and shifts its times to
+    start at zero, as if that part of the audio had been transcribed on its own
+    Helper function for ``FakeTranscribeClient.start_transcription_job()``
+    """
+    def local(time_stamp):
+        return f"{float(time_stamp) - start:.3f}"
+
+    def slice_items(all_items):
+        items = []
+        keeping = False
+        for item in all_items:
+            if 'start_time' in item:
+                keeping = start <= float(item['start_time']) and float(item['end_time']) <= end
+                if keeping:
+                    item = dict(item, start_time=local(item['start_time']), end_time=local(item['end_time']))
+                    if 'speaker_label' in item:
+                        item['speaker_label'] = relabel.get(item['speaker_label'], item['speaker_label'])
+            if keeping:
+                items.append(item)
+        return items
+
+    sliced = {'transcripts': [{'transcript': ''}], 'items': slice_items(results['items'])}
+    if 'channel_labels' in results:
+        sliced['channel_labels'] = {
+            'channels': [dict(channel, items=slice_items(channel['items']))
+                         for channel in results['channel_labels']['channels']],
+            'number_of_channels': results['channel_labels']['number_of_channels']
+        }
+    if 'speaker_labels' in results:
+        segments = []
+        for segment in results['speaker_labels']['segments']:
+            seg_start = max(float(segment['start_time']), start)
+            seg_end = min(float(segment['end_time']), end)
+            if seg_end <= seg_start:
+                continue
+            speaker = relabel.get(segment['speaker_label'], segment['speaker_label'])
+            segments.append({
+                'start_time': f"{seg_start - start:.3f}",
+                'end_time': f"{seg_end - start:.3f}",
+                'speaker_label': speaker,
+                'items': [dict(word, start_time=local(word['start_time']), end_time=local(word['end_time']),
+                               speaker_label=speaker)
+                          for word in segment.get('items', [])
+                          if start <= float(word['start_time']) and float(word['end_time']) <= end]
+            })
+        sliced['speaker_labels'] = {'speakers': results['speaker_labels']['speakers'], 'segments': segments}
+    return sliced
@@ -0,0 +1,51 @@
+import struct
+
+import audio_splitter
+
+
+def make_id3_tag(size):
+    """
+    Builds an ID3v2.4 tag with size bytes of padding, its size stored as four 7-bit bytes
+    """
+    syncsafe = bytes([(size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F])
+    return b'ID3\x04\x00\x00' + syncsafe + b'\x00' * size
+
+
+def make_mp3_frame_header(channel_mode):
+    """
+    Builds the header of an MPEG-1 layer III frame at 128 kbit/s and 44.1 kHz with the given channel mode
+    """
+    return bytes([0xFF, 0xFB, 0x90, channel_mode << 6])
+
+
+def make_flac_header(channels):
+    """
+    Builds the fLaC marker and a STREAMINFO block of a 16-bit 8 kHz flac file
+    """
+    packed = (8000 << 12) | ((channels - 1) << 9) | (15 << 4)
+    streaminfo = struct.pack('>HH', 4096, 4096) + b'\x00' * 6 + struct.pack('>I', packed) + b'\x00' * 24
+    return b'fLaC' + bytes([0x80, 0, 0, len(streaminfo)]) + streaminfo
+
+
+def test_mp3_channel_mode_after_id3_tag():
+    header = make_id3_tag(300) + make_mp3_frame_header(1) + b'\x00' * 100
+    tag_size = audio_splitter.id3_tag_size(header)
+
+    assert tag_size == 310
+    assert audio_splitter.get_channel_count(header[tag_size:], "mp3") == 2
+    assert audio_splitter.get_channel_count(make_mp3_frame_header(3), "mp3") == 1
+
+
+def test_mp3_skips_bytes_that_only_look_like_a_frame_sync():
+    # A reserved sample rate index makes the first sync invalid
+    header = bytes([0xFF, 0xFB, 0x9C, 0x00]) + make_mp3_frame_header(3)
+
+    assert audio_splitter.get_channel_count(header, "mp3") == 1
+    assert audio_splitter.get_channel_count(b'\x00' * 64, "mp3") == 0
+
+
+def test_flac_streaminfo_channels():
+    assert audio_splitter.get_channel_count(make_flac_header(2), "flac") == 2
+    assert audio_splitter.get_channel_count(make_flac_header(1), "flac") == 1
+    assert audio_splitter.get_channel_count(b'RIFF' + b'\x00' * 40, "flac") == 0
+    assert audio_splitter.get_channel_count(make_flac_header(2), "mp4") == 0
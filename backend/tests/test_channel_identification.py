@@ -0,0 +1,61 @@
+from fake_transcribe import slice_results
+from process_transcription_full_text import chunk_up_transcript, merge_channel_items
+from transcript_stitcher import stitch_results
+
+
+def word(content, start):
+    return {'type': 'pronunciation', 'start_time': f"{start:.3f}", 'end_time': f"{start + 0.4:.3f}",
+            'alternatives': [{'content': content}]}
+
+
+def punctuation(content):
+    return {'type': 'punctuation', 'alternatives': [{'content': content}]}
+
+
+def make_channel_results():
+    """
+    Builds a channel identification result in which the caller and the call-taker take turns
+    """
+    return {
+        'transcripts': [{'transcript': ''}],
+        'items': [],
+        'channel_labels': {
+            'channels': [
+                {'channel_label': 'ch_0',
+                 'items': [word('Hello', 0.0), punctuation(','), word('there', 1.0), punctuation('.'),
+                           word('Bye', 30.0), punctuation('.')]},
+                {'channel_label': 'ch_1',
+                 'items': [word('Yes', 0.5), punctuation('?'), word('sure', 2.0), punctuation('.'),
+                           word('later', 25.0), punctuation('!')]}
+            ],
+            'number_of_channels': 2
+        }
+    }
+
+
+def test_channels_are_interleaved_by_time_with_punctuation_after_its_word():
+    merged = [(item['alternatives'][0]['content'], label) for item, label in
+              merge_channel_items(make_channel_results())]
+
+    assert merged == [('Hello', 'ch_0'), (',', 'ch_0'), ('Yes', 'ch_1'), ('?', 'ch_1'), ('there', 'ch_0'),
+                      ('.', 'ch_0'), ('sure', 'ch_1'), ('.', 'ch_1'), ('later', 'ch_1'), ('!', 'ch_1'),
+                      ('Bye', 'ch_0'), ('.', 'ch_0')]
+
+
+def test_channel_paragraphs_are_labelled_by_channel():
+    _, paragraphs = chunk_up_transcript(None, make_channel_results())
+
+    # The transcript starts with the empty paragraph before the first speaker
+    assert paragraphs.split('\n\n') == ['', 'ch_0 : Hello,', 'ch_1 : Yes?', 'ch_0 : there.', 'ch_1 : sure. later!',
+                                        'ch_0 : Bye.']
+
+
+def test_split_channel_transcript_reads_like_a_single_job():
+    results = make_channel_results()
+    segments = [{'start': 0.0, 'end': 24.0, 'cut': 20.0}, {'start': 20.0, 'end': 40.0, 'cut': 40.0}]
+    segment_results = [dict(segment, results=slice_results(results, segment['start'], segment['end'], {}))
+                       for segment in segments]
+
+    stitched = stitch_results(segment_results)
+
+    assert chunk_up_transcript(None, stitched)[1] == chunk_up_transcript(None, results)[1]
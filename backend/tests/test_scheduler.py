@@ -0,0 +1,79 @@
+import itertools
+from types import SimpleNamespace
+
+import pytest
+
+import scheduler
+from scheduler import BATCH, BULK, INTERACTIVE, LANE_WEIGHTS, plan_dequeue, plan_lanes, throttle_map_runs
+
+
+@pytest.mark.parametrize('running_interactive, depth_interactive, running_bulk, running_batch',
+                         list(itertools.product((0, 5, 10, 30, 55), (0, 3, 20, 100), (0, 10, 45), (0, 15, 60))))
+def test_bulk_work_stays_out_of_the_interactive_capacity(running_interactive, depth_interactive, running_bulk,
+                                                         running_batch):
+    running = {INTERACTIVE: running_interactive, BULK: running_bulk, BATCH: running_batch}
+    depths = {INTERACTIVE: depth_interactive, BULK: 100, BATCH: 1000}
+
+    planned = plan_lanes(running, depths)
+
+    interactive_demand = running_interactive + depth_interactive
+    bulk_capacity = scheduler.MAX_RUNNING - max(scheduler.INTERACTIVE_RESERVED, interactive_demand)
+    assert planned[BULK] + planned[BATCH] <= max(0, bulk_capacity - running_bulk - running_batch)
+    assert sum(planned.values()) <= max(0, scheduler.MAX_RUNNING - sum(running.values()))
+    assert planned[INTERACTIVE] == min(depth_interactive, max(0, scheduler.MAX_RUNNING - sum(running.values())))
+
+
+def test_lanes_share_free_capacity_by_weight():
+    depths = {INTERACTIVE: 100, BULK: 100, BATCH: 100}
+
+    planned = plan_dequeue(60, depths, LANE_WEIGHTS, {lane: 60 for lane in depths})
+
+    assert (LANE_WEIGHTS[INTERACTIVE], LANE_WEIGHTS[BULK], LANE_WEIGHTS[BATCH]) == (4, 1, 1)
+    assert planned == {INTERACTIVE: 40, BULK: 10, BATCH: 10}
+
+
+def test_idle_lane_capacity_goes_to_the_other_lanes():
+    depths = {INTERACTIVE: 2, BULK: 100, BATCH: 0}
+
+    planned = plan_dequeue(20, depths, LANE_WEIGHTS, {INTERACTIVE: 20, BULK: 15, BATCH: 15})
+
+    assert planned == {INTERACTIVE: 2, BULK: 15, BATCH: 0}
+
+
+def test_bulk_lane_and_batch_imports_split_the_bulk_capacity_by_weight():
+    running = {INTERACTIVE: 0, BULK: 0, BATCH: 0}
+    depths = {INTERACTIVE: 0, BULK: 100, BATCH: 100}
+
+    planned = plan_lanes(running, depths)
+
+    bulk_capacity = scheduler.MAX_RUNNING - scheduler.INTERACTIVE_RESERVED
+    assert planned == {INTERACTIVE: 0, BULK: bulk_capacity // 2, BATCH: bulk_capacity // 2}
+
+
+def throttle(monkeypatch, map_runs, count):
+    updates = {}
+    client = SimpleNamespace(update_map_run=lambda mapRunArn, maxConcurrency:
+                             updates.__setitem__(mapRunArn, maxConcurrency))
+    monkeypatch.setattr(scheduler, 'STEPFUNCTIONS_CLIENT', client)
+    return throttle_map_runs(map_runs, count), updates
+
+
+def test_map_runs_share_the_planned_batch_items(monkeypatch):
+    map_runs = [{'mapRunArn': 'a', 'running': 10, 'pending': 500, 'maxConcurrency': 40},
+                {'mapRunArn': 'b', 'running': 2, 'pending': 3, 'maxConcurrency': 40}]
+
+    started, updates = throttle(monkeypatch, map_runs, 9)
+
+    # The second map run only has 3 items left, the rest of its share goes to the first
+    assert started == 9
+    assert updates == {'a': 16, 'b': 5}
+
+
+def test_map_run_max_concurrency_never_drops_below_one(monkeypatch):
+    map_runs = [{'mapRunArn': 'a', 'running': 0, 'pending': 500, 'maxConcurrency': 40},
+                {'mapRunArn': 'b', 'running': 0, 'pending': 0, 'maxConcurrency': 1}]
+
+    started, updates = throttle(monkeypatch, map_runs, 0)
+
+    assert started == 0
+    assert updates == {'a': 1}
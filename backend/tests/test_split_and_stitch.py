@@ -0,0 +1,216 @@
+import array
+import io
+import json
+import math
+import wave
+from types import SimpleNamespace
+from urllib.request import urlopen
+
+import audio_splitter
+import call_transcribe
+import check_transcribe
+import process_transcription_full_text
+from fake_s3 import FakeS3Client
+from fake_transcribe import FakeTranscribeClient
+from transcript_stitcher import stitch_results
+
+SAMPLE_RATE = 8000
+DURATION_SECONDS = 70
+# Every 3 second block has 2.5 seconds of speech followed by half a second of silence
+BLOCK_SECONDS = 3
+SPEECH_SECONDS = 2.5
+
+
+def make_recording():
+    """
+    Builds a 16-bit mono wav recording with a silence at the end of every block
+    """
+    samples = array.array('h', (0 if (i / SAMPLE_RATE) % BLOCK_SECONDS >= SPEECH_SECONDS
+                                else int(8000 * math.sin(i / 5))
+                                for i in range(SAMPLE_RATE * DURATION_SECONDS)))
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+def make_reference_results(speaker_of_block=lambda block: block % 2):
+    """
+    Builds the Transcribe result of the whole recording, five words per block and by default the speakers
+    taking turns
+    """
+    items = []
+    segments = []
+    for block in range(DURATION_SECONDS // BLOCK_SECONDS):
+        speaker = f"spk_{speaker_of_block(block)}"
+        words = []
+        for index in range(5):
+            start = block * BLOCK_SECONDS + index * 0.5
+            word = {'start_time': f"{start:.3f}", 'end_time': f"{start + 0.4:.3f}", 'type': 'pronunciation',
+                    'alternatives': [{'content': f"w{block}_{index}"}]}
+            items.append(word)
+            words.append({'start_time': word['start_time'], 'end_time': word['end_time'],
+                          'speaker_label': speaker})
+        items.append({'type': 'punctuation', 'alternatives': [{'content': '.'}]})
+        segments.append({'start_time': f"{block * BLOCK_SECONDS:.3f}",
+                         'end_time': f"{block * BLOCK_SECONDS + 2.4:.3f}",
+                         'speaker_label': speaker, 'items': words})
+    return {'transcripts': [{'transcript': ''}], 'items': items,
+            'speaker_labels': {'speakers': 2, 'segments': segments}}
+
+
+def plan_recording(monkeypatch, recording):
+    """
+    Shortens the segments so the 70 second recording is split in three, and plans its segments
+    """
+    monkeypatch.setattr(audio_splitter, 'TARGET_SEGMENT_SECONDS', 20.0)
+    monkeypatch.setattr(audio_splitter, 'OVERLAP_SECONDS', 4.0)
+    monkeypatch.setattr(audio_splitter, 'SILENCE_SEARCH_SECONDS', 2.0)
+    wav_format = audio_splitter.read_wav_format(recording[:65536])
+
+    def read_energies(first_window, end_window):
+        first, last = audio_splitter.window_byte_range(wav_format, first_window, end_window)
+        return audio_splitter.window_energies(io.BytesIO(recording[first:last + 1]), wav_format, last - first + 1)
+
+    return wav_format, audio_splitter.plan_segments(read_energies, audio_splitter.recording_duration(wav_format))
+
+
+def split_and_transcribe(tmp_path, monkeypatch, reference=None):
+    _, segments = plan_recording(monkeypatch, make_recording())
+
+    client = FakeTranscribeClient(reference or make_reference_results(), str(tmp_path), polls_until_complete=0)
+    segment_results = []
+    for index, segment in enumerate(segments):
+        client.register_media(f"segment-{index}", segment['start'], segment['end'])
+        client.start_transcription_job(TranscriptionJobName=f"job-seg{index:03d}",
+                                       Media={'MediaFileUri': f"segment-{index}"})
+        response = client.get_transcription_job(TranscriptionJobName=f"job-seg{index:03d}")
+        url = response['TranscriptionJob']['Transcript']['RedactedTranscriptFileUri']
+        segment_results.append(dict(segment, results=json.loads(urlopen(url).read())['results']))
+    return segments, segment_results
+
+
+def test_segments_are_cut_at_silences_and_overlap(tmp_path, monkeypatch):
+    segments, _ = split_and_transcribe(tmp_path, monkeypatch)
+
+    assert len(segments) == 3
+    for segment, following in zip(segments, segments[1:]):
+        assert segment['cut'] % BLOCK_SECONDS >= SPEECH_SECONDS
+        assert following['start'] == segment['cut']
+        assert segment['end'] > segment['cut']
+
+
+def test_stitch_restores_words_without_overlap_duplicates(tmp_path, monkeypatch):
+    _, segment_results = split_and_transcribe(tmp_path, monkeypatch)
+    reference = make_reference_results()
+
+    # The overlaps were transcribed twice, so the segments hold more words than the recording
+    segment_words = sum(len(result['results']['items']) for result in segment_results)
+    assert segment_words > len(reference['items'])
+
+    stitched = stitch_results(segment_results)
+    assert [(item['alternatives'][0]['content'], item.get('start_time')) for item in stitched['items']] == \
+        [(item['alternatives'][0]['content'], item.get('start_time')) for item in reference['items']]
+
+
+def test_stitch_reconciles_swapped_speaker_labels(tmp_path, monkeypatch):
+    _, segment_results = split_and_transcribe(tmp_path, monkeypatch)
+    reference = make_reference_results()
+
+    # The fake swaps the labels of the second segment, like a separate diarization would
+    assert segment_results[1]['results']['speaker_labels']['segments'][0]['speaker_label'] != \
+        [segment for segment in reference['speaker_labels']['segments']
+         if float(segment['start_time']) >= segment_results[1]['start']][0]['speaker_label']
+
+    stitched = stitch_results(segment_results)
+    assert stitched['speaker_labels']['speakers'] == 2
+    assert [(segment['start_time'], segment['end_time'], segment['speaker_label'])
+            for segment in stitched['speaker_labels']['segments']] == \
+        [(segment['start_time'], segment['end_time'], segment['speaker_label'])
+         for segment in reference['speaker_labels']['segments']]
+
+
+def test_stitch_keeps_speakers_that_are_silent_in_the_overlap(tmp_path, monkeypatch):
+    # Only spk_0 talks from a little before each cut until after the overlap that follows it
+    monologues = {6, 7, 8, 13, 14, 15}
+    reference = make_reference_results(lambda block: 0 if block in monologues else block % 2)
+    segments, segment_results = split_and_transcribe(tmp_path, monkeypatch, reference)
+    for segment in segments[:-1]:
+        assert 6 * BLOCK_SECONDS <= segment['cut'] < 9 * BLOCK_SECONDS - 4 or \
+            13 * BLOCK_SECONDS <= segment['cut'] < 16 * BLOCK_SECONDS - 4
+
+    stitched = stitch_results(segment_results)
+    assert stitched['speaker_labels']['speakers'] == 2
+    assert [(segment['start_time'], segment['speaker_label'])
+            for segment in stitched['speaker_labels']['segments']] == \
+        [(segment['start_time'], segment['speaker_label'])
+         for segment in reference['speaker_labels']['segments']]
+
+
+def start_recording_jobs(tmp_path, monkeypatch, polls_until_complete=1):
+    """
+    Runs ``call_transcribe.start_segment_jobs()`` for the recording with fake S3 and Transcribe clients
+    """
+    recording = make_recording()
+    wav_format, segments = plan_recording(monkeypatch, recording)
+    s3 = FakeS3Client()
+    s3.put_object(Body=recording, Bucket='calls', Key='call.wav')
+    client = FakeTranscribeClient(make_reference_results(), str(tmp_path / 'jobs'),
+                                  polls_until_complete=polls_until_complete)
+    for index, segment in enumerate(segments):
+        client.register_media(f"https://s3-{call_transcribe.REGION}.amazonaws.com/segments/calls/segments/"
+                              f"bulk-ABC/segment_{index:03d}.wav", segment['start'], segment['end'])
+    monkeypatch.setattr(call_transcribe, 'S3_CLIENT', s3)
+    monkeypatch.setattr(call_transcribe, 'TRANSCRIBE_CLIENT', client)
+    monkeypatch.setattr(call_transcribe, 'SEGMENT_BUCKET', 'segments')
+    monkeypatch.setattr(check_transcribe, 'TRANSCRIBE_CLIENT', client)
+
+    jobs = call_transcribe.start_segment_jobs('calls', 'call.wav', 'bulk-ABC', 'wav', False, wav_format)
+    return segments, jobs, s3, client
+
+
+def test_segment_jobs_are_started_once(tmp_path, monkeypatch):
+    segments, jobs, s3, client = start_recording_jobs(tmp_path, monkeypatch)
+
+    assert [job['transcribeJob'] for job in jobs] == ['bulk-ABC-seg000', 'bulk-ABC-seg001', 'bulk-ABC-seg002']
+    assert [(job['start'], job['end'], job['cut']) for job in jobs] == \
+        [(segment['start'], segment['end'], segment['cut']) for segment in segments]
+    assert ('segments', 'calls/segments/bulk-ABC/segment_001.wav') in s3.objects
+
+    # A retried step finds the jobs it already started instead of failing on their names
+    assert call_transcribe.start_segment_jobs('calls', 'call.wav', 'bulk-ABC', 'wav', False,
+                                              audio_splitter.read_wav_format(make_recording()[:65536])) == jobs
+    assert len(client.jobs) == len(segments)
+
+
+def test_check_and_process_segment_jobs(tmp_path, monkeypatch):
+    _, jobs, s3, _ = start_recording_jobs(tmp_path, monkeypatch)
+    event = {'callTranscribeResult': {'transcribeJobs': jobs}, 'progressiveIndexing': False}
+
+    assert check_transcribe.lambda_handler(event, None) == {'status': 'IN_PROGRESS'}
+    check_result = check_transcribe.lambda_handler(event, None)
+    assert check_result['status'] == 'COMPLETED'
+    assert [url['start'] for url in check_result['segmentTranscriptionUrls']] == [job['start'] for job in jobs]
+
+    comprehend = SimpleNamespace(batch_detect_key_phrases=lambda **kwargs: {'ResultList': []},
+                                 batch_detect_syntax=lambda **kwargs: {'ResultList': []})
+    monkeypatch.setattr(process_transcription_full_text, 'COMPREHEND_CLIENT', comprehend)
+    monkeypatch.setattr(process_transcription_full_text, 'S3_CLIENT', s3)
+    location = process_transcription_full_text.lambda_handler(dict(event, checkTranscribeResult=check_result), None)
+
+    transcript = json.loads(s3.get_object(Bucket=location['bucket'], Key=location['key'])['Body'].read())
+    # The split recording reads exactly like the transcript of a single job over the whole recording
+    _, expected = process_transcription_full_text.chunk_up_transcript(None, make_reference_results())
+    assert transcript['transcript'] == expected
+    assert 'spk_2' not in transcript['transcript']
+
+
+def test_check_fails_when_one_segment_job_fails(tmp_path, monkeypatch):
+    _, jobs, _, client = start_recording_jobs(tmp_path, monkeypatch, polls_until_complete=0)
+    client.fail_job(jobs[1]['transcribeJob'])
+
+    assert check_transcribe.lambda_handler({'callTranscribeResult': {'transcribeJobs': jobs}}, None) == \
+        {'status': 'FAILED'}